@@ -0,0 +1,168 @@
+import json
+import os
+import time
+
+import numpy as np
+
+from content_index import build_postings
+from model_store import IsbnMap, artifact_path
+from neighbor_index import top_k_neighbors
+from similarity import normalize_rows
+
+# Approximate nearest neighbors over the whole rated catalog, built by model_builder.py
+# with ANN_INDEX=1. Books are embedded with a truncated SVD of their row-normalized rating
+# vectors (dot products approximate the pivot's cosine similarity), then partitioned by
+# spherical k-means into inverted lists (IVF). Vectors are stored grouped by list, so a
+# query scores the `nprobe` closest centroids and then a few contiguous slices instead of
+# every book: nprobe is the recall/latency knob (ANN_NPROBE in app.py).
+ANN_ISBNS_FILE = 'ann_isbns.npy'            # row -> ISBN, grouped by list
+ANN_ISBN_KEYS_FILE = 'ann_isbn_keys.npy'    # sorted ISBNs  } ISBN -> row,
+ANN_ISBN_ROWS_FILE = 'ann_isbn_rows.npy'    # row of each key } like IsbnMap
+ANN_VECTORS_FILE = 'ann_vectors.npy'        # (n, dim) float32, unit length
+ANN_CENTROIDS_FILE = 'ann_centroids.npy'    # (n_lists, dim) float32, unit length
+ANN_OFFSETS_FILE = 'ann_offsets.npy'        # rows offsets[l]:offsets[l + 1] belong to list l
+ANN_META_FILE = 'ann_meta.json'             # build settings and the recall@K report
+ANN_FILES = [ANN_ISBNS_FILE, ANN_ISBN_KEYS_FILE, ANN_ISBN_ROWS_FILE, ANN_VECTORS_FILE,
+             ANN_CENTROIDS_FILE, ANN_OFFSETS_FILE, ANN_META_FILE]
+
+DEFAULT_DIM = 64
+DEFAULT_NPROBE = 8
+KMEANS_ITERATIONS = 20
+KMEANS_SAMPLE_PER_LIST = 64   # k-means trains on at most this many points per list
+CHUNK_ROWS = 8192             # rows scored against the centroids (or the catalog) at once
+RECALL_NPROBES = (1, 2, 4, 8, 16, 32, 64)
+
+
+def item_embeddings(pivot, dim=DEFAULT_DIM, seed=0):
+    # Unit-length rows of U * S from a rank-`dim` SVD of the row-normalized pivot.
+    # Books whose vector is all zeros (only implicit 0 ratings) get a zero embedding.
+    from sklearn.utils.extmath import randomized_svd
+
+    dim = max(1, min(dim, min(pivot.shape) - 1))
+    u, s, _ = randomized_svd(normalize_rows(pivot.astype(np.float32)), dim, random_state=seed)
+    vectors = (u * s).astype(np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return np.divide(vectors, norms, out=np.zeros_like(vectors), where=norms > 0)
+
+
+def _nearest(vectors, centroids):
+    # Index of the closest centroid (highest dot product) for every row, in bounded chunks
+    out = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), CHUNK_ROWS):
+        out[start:start + CHUNK_ROWS] = np.argmax(vectors[start:start + CHUNK_ROWS] @ centroids.T, axis=1)
+    return out
+
+
+def spherical_kmeans(vectors, n_lists, iterations=KMEANS_ITERATIONS, seed=0):
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), n_lists * KMEANS_SAMPLE_PER_LIST)
+    sample = vectors[rng.choice(len(vectors), sample_size, replace=False)]
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = _nearest(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, sample)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        # Lists that lost every point restart from a random sample point
+        sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+        norms[empty] = 1.0
+        centroids = (sums / norms).astype(np.float32)
+    return centroids
+
+
+def default_lists(n):
+    # ~4 * sqrt(n) lists keeps both the centroid scan and each list short
+    return int(np.clip(4 * np.sqrt(n), 1, max(n // 8, 1)))
+
+
+def build_ann_index(out_dir, isbns, pivot, dim=DEFAULT_DIM, n_lists=None, seed=0, recall_sample=1000, k=10):
+    vectors = item_embeddings(pivot, dim, seed)
+    keep = np.flatnonzero(np.linalg.norm(vectors, axis=1) > 0)
+    isbns, vectors = np.asarray([str(i).strip() for i in np.asarray(isbns)[keep]]), vectors[keep]
+    n_lists = min(n_lists or default_lists(len(vectors)), len(vectors))
+    centroids = spherical_kmeans(vectors, n_lists, seed=seed)
+    offsets, rows = build_postings(_nearest(vectors, centroids), n_lists)
+    isbns, vectors = isbns[rows], vectors[rows]
+    order = np.argsort(isbns, kind='stable')
+
+    arrays = {
+        ANN_ISBNS_FILE: isbns, ANN_ISBN_KEYS_FILE: isbns[order], ANN_ISBN_ROWS_FILE: order.astype(np.int32),
+        ANN_VECTORS_FILE: vectors, ANN_CENTROIDS_FILE: centroids, ANN_OFFSETS_FILE: offsets,
+    }
+    for name, array in arrays.items():
+        np.save(artifact_path(out_dir, name), array)
+    index = AnnIndex(out_dir)
+    meta = {"books": int(len(isbns)), "dim": int(vectors.shape[1]), "lists": int(n_lists),
+            "recall": recall_report(index, k=k, sample=recall_sample, seed=seed)}
+    with open(artifact_path(out_dir, ANN_META_FILE), 'w') as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+def recall_report(index, k=10, sample=1000, nprobes=RECALL_NPROBES, seed=0):
+    # recall@k of the IVF search against exact search over the same vectors, per nprobe,
+    # with the mean single-query latency, for a random sample of books. A result counts
+    # when it scores at least the exact k-th best, so books with tied vectors don't
+    # depend on which of them each search happened to keep.
+    rng = np.random.default_rng(seed)
+    queries = rng.choice(len(index), min(sample, len(index)), replace=False)
+    vectors = np.asarray(index.vectors)
+    kth_best = np.concatenate([
+        top_k_neighbors(vectors[queries[start:start + 64]] @ vectors.T, k, exclude=queries[start:start + 64])[1][:, -1]
+        for start in range(0, len(queries), 64)])
+    report = []
+    for nprobe in nprobes:
+        if nprobe > index.n_lists:
+            break
+        hits, started = 0, time.perf_counter()
+        for row, threshold in zip(queries, kth_best):
+            _, scores = index.search(row, k, nprobe)
+            hits += int(np.sum(scores >= threshold - 1e-6))
+        elapsed = time.perf_counter() - started
+        report.append({"nprobe": nprobe, f"recall@{k}": round(hits / (len(queries) * k), 4),
+                       "query_ms": round(elapsed * 1000 / len(queries), 3)})
+    return report
+
+
+class AnnIndex:
+    def __init__(self, model_dir):
+        load = lambda name: np.load(artifact_path(model_dir, name), mmap_mode='r')
+        self.isbns = load(ANN_ISBNS_FILE)
+        self.isbn_map = IsbnMap(load(ANN_ISBN_KEYS_FILE), load(ANN_ISBN_ROWS_FILE))
+        self.vectors = load(ANN_VECTORS_FILE)
+        self.centroids = np.asarray(load(ANN_CENTROIDS_FILE))  # small, scanned by every query
+        self.offsets = load(ANN_OFFSETS_FILE)
+        self.n_lists = len(self.centroids)
+
+    @classmethod
+    def load(cls, model_dir):
+        # None when the model was built without ANN_INDEX=1.
+        if not os.path.exists(artifact_path(model_dir, ANN_META_FILE)):
+            return None
+        return cls(model_dir)
+
+    def __contains__(self, isbn):
+        return isbn in self.isbn_map
+
+    def __len__(self):
+        return len(self.isbns)
+
+    def search(self, row, k, nprobe=DEFAULT_NPROBE):
+        # Rows and scores of the k best matches for `row` among the nprobe closest lists
+        query = np.asarray(self.vectors[row])
+        nprobe = min(nprobe, self.n_lists)
+        lists = np.argpartition(-(self.centroids @ query), nprobe - 1)[:nprobe]
+        candidates = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+        candidates = candidates[candidates != row]
+        if len(candidates) == 0:
+            return candidates, np.empty(0, dtype=np.float32)
+        # Lists are contiguous, so gathering their vectors reads whole runs of pages
+        scores = np.asarray(self.vectors[candidates]) @ query
+        ids, best = top_k_neighbors(scores[np.newaxis, :], k)
+        return candidates[ids[0]], best[0]
+
+    def neighbors(self, isbn, n=5, nprobe=DEFAULT_NPROBE):
+        # Same shape as NeighborIndex.neighbors(); raises KeyError for ISBNs outside the index
+        rows, scores = self.search(self.isbn_map.row(isbn), n, nprobe)
+        return [(str(self.isbns[r]), float(s)) for r, s in zip(rows, scores)]
@@ -1,24 +1,44 @@
-import pickle
 import os
+import json
+import math
 import random
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from flask import Flask, request, jsonify
+import atexit
+import tempfile
+from flask import Flask, request, jsonify, Response, stream_with_context, g, has_request_context, send_from_directory
 from flask_cors import CORS
-import pandas as pd
+import numpy as np
 from werkzeug.security import generate_password_hash, check_password_hash
-from flask_jwt_extended import create_access_token, jwt_required, JWTManager, get_jwt_identity
+from flask_jwt_extended import create_access_token, jwt_required, JWTManager, get_jwt_identity, get_jwt, verify_jwt_in_request
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt.exceptions import PyJWTError
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-from sqlalchemy import func
+from sqlalchemy import func, case, or_, and_, literal, text, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from functools import wraps
+import click
 from dotenv import load_dotenv
 import re # New: Import th regex module
 from datetime import datetime
 from werkzeug.utils import secure_filename
 import time
-from supabase import create_client, Client # <-- NEW IMPORT
+from model_store import ModelArtifacts, MODEL_DIR
+from neighbor_index import top_k_neighbors
+from svd_model import SvdModel
+from content_index import ContentIndex
+from ann_index import AnnIndex, DEFAULT_NPROBE
+from hybrid_ranker import DEFAULT_WEIGHTS, Budget, parse_weights, signal_matrix, lookup_scores, content_affinity, popularity, filter_mask, rank
+from cache import TTLCache, make_response_cache, response_key
+from db_routing import RoutingSession, engine_options, replica_binds, make_primary_pins, REPLICA_BIND
+from mailer import MailQueue, QueueFull
+from otp_store import make_otp_store, SqlOtpStore, TooManyRequests, TooManyAttempts
+from metrics import Registry
+from photos import PhotoPipeline, InvalidPhoto, PHOTO_MAX_BYTES, photo_paths, probe as probe_photo
+from storage import make_storage
+from profiler import SamplingProfiler
+from search_index import LocalSearchIndex, SEARCH_PAGE_SIZE, MAX_SEARCH_PAGE_SIZE, encode_cursor, decode_cursor
 
 load_dotenv()
 import os
@@ -28,27 +48,112 @@ load_dotenv()
 
 # --- 1. App Initialization & Configuration ---
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Cursor', 'X-Ranker-Skipped'])
 app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Pool sizing and timeouts: DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+# DB_STATEMENT_TIMEOUT_MS (see db_routing.py). DATABASE_REPLICA_URL routes the read-only endpoints to a replica.
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(os.getenv('DATABASE_URL'))
+app.config['SQLALCHEMY_BINDS'] = replica_binds(os.getenv('DATABASE_REPLICA_URL'))
 app.config["JWT_SECRET_KEY"] = os.getenv('JWT_SECRET_KEY')
 
-# Initialize Supabase Client for Storage
+# Storage for profile photos: Supabase Storage, or STORAGE_BACKEND=local to keep them under
+# LOCAL_STORAGE_DIR (served at /media). The Supabase client is only created on first upload.
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'supabase')
+LOCAL_STORAGE_DIR = os.getenv('LOCAL_STORAGE_DIR', 'uploads')
+photo_storage = make_storage(STORAGE_BACKEND, "Profile Photo", SUPABASE_URL, SUPABASE_KEY, LOCAL_STORAGE_DIR,
+                             os.getenv('LOCAL_STORAGE_URL', 'http://127.0.0.1:5000/media'))
+photo_pipeline = PhotoPipeline(photo_storage)
 
 # --- 2. Initialize Extensions ---
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 migrate = Migrate(app, db)
 jwt = JWTManager(app)
 
 # --- 3. Load ML Model Files ---
-pivot_table = pickle.load(open('pivot.pkl', 'rb'))
-similarity_scores = pickle.load(open('similarity_scores.pkl', 'rb'))
+# .npy artifacts written by model_builder.py, opened with mmap so workers share pages
+model = ModelArtifacts(MODEL_DIR)
+neighbor_index = model.neighbor_index
+# Optional SVD factors from surprise_model_builder.py (None until it has been run)
+svd_model = SvdModel.load(model.path)
+# Author/genre posting lists over the catalog for cold-start books (None if built without books_enriched.csv)
+content_index = ContentIndex.load(model.path)
+# Approximate neighbors for rated books outside the item-item model (None unless built with ANN_INDEX=1).
+# ANN_NPROBE trades latency for recall; model_builder.py prints recall@10 for each setting.
+ann_index = AnnIndex.load(model.path)
+ANN_NPROBE = int(os.getenv('ANN_NPROBE', str(DEFAULT_NPROBE)))
+# /recommend/hybrid: blend weights per signal (cf, svd, content, popularity), candidates taken from
+# each source, and the default latency budget (requests may ask for MIN_ to MAX_HYBRID_BUDGET_MS)
+HYBRID_WEIGHTS = parse_weights(os.getenv('HYBRID_WEIGHTS', DEFAULT_WEIGHTS))
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', '50'))
+HYBRID_BUDGET_MS = float(os.getenv('HYBRID_BUDGET_MS', '50'))
+MIN_HYBRID_BUDGET_MS, MAX_HYBRID_BUDGET_MS = 5, 1000
+# How often (seconds) a worker checks MODEL_DIR/CURRENT for a newly published version
+MODEL_RELOAD_INTERVAL = float(os.getenv('MODEL_RELOAD_INTERVAL', '10'))
+model_checked_at = time.monotonic()
 
-# --- 4. In-Memory OTP Storage ---
-otp_storage = {}
+# --- 4. Book Metadata Caches ---
+# Serialized Book rows keyed by ISBN (None = ISBN not in the catalog) and the
+# content-based fallback picks per ISBN. Both are cleared by /admin/add-book.
+book_cache = TTLCache(maxsize=int(os.getenv('BOOK_CACHE_SIZE', '50000')), ttl=int(os.getenv('BOOK_CACHE_TTL', '600')))
+fallback_cache = TTLCache(maxsize=int(os.getenv('BOOK_CACHE_SIZE', '50000')), ttl=int(os.getenv('BOOK_CACHE_TTL', '600')))
+# Whole /recommend and /search responses, keyed by query parameters and model version. In-process
+# by default; set RESPONSE_CACHE_URL=redis://... to share one cache between workers and nodes.
+response_cache = make_response_cache(os.getenv('RESPONSE_CACHE_URL'), maxsize=int(os.getenv('RESPONSE_CACHE_SIZE', '10000')), ttl=int(os.getenv('RESPONSE_CACHE_TTL', '60')))
+# Users who just wrote read from the primary for REPLICA_PIN_SECONDS (read-your-writes with a replica)
+primary_pins = make_primary_pins(os.getenv('REPLICA_PIN_URL', os.getenv('RESPONSE_CACHE_URL')))
+# Caller identity for tokens issued before they carried user_id/is_admin claims (username -> claims),
+# and each user's {book_id: rating} for /search. /rate drops the rater's map; other workers
+# may serve it for up to RATING_MAP_CACHE_TTL seconds.
+identity_cache = TTLCache(maxsize=int(os.getenv('IDENTITY_CACHE_SIZE', '10000')), ttl=int(os.getenv('IDENTITY_CACHE_TTL', '300')))
+rating_map_cache = TTLCache(maxsize=int(os.getenv('RATING_MAP_CACHE_SIZE', '10000')), ttl=int(os.getenv('RATING_MAP_CACHE_TTL', '30')))
+# Rating count and average per ISBN, and the most rated ISBNs per genre, for /recommend/hybrid.
+# Not invalidated by /rate: popularity moves slowly, so POPULARITY_CACHE_TTL seconds of lag is fine.
+popularity_cache = TTLCache(maxsize=int(os.getenv('BOOK_CACHE_SIZE', '50000')), ttl=int(os.getenv('POPULARITY_CACHE_TTL', '300')))
+popular_cache = TTLCache(maxsize=1000, ttl=int(os.getenv('POPULARITY_CACHE_TTL', '300')))
+
+# --- 4b. Outgoing Mail ---
+# OTP e-mails are queued and delivered by background threads over pooled SMTP connections
+# (MAIL_HOST/MAIL_PORT/MAIL_SSL, see mailer.py); queued mail gets a few seconds to go out on shutdown.
+mail_queue = MailQueue(username=os.getenv("EMAIL_USER"), password=os.getenv("EMAIL_PASS"))
+atexit.register(mail_queue.join, 5)
+
+# --- 4c. Instrumentation ---
+# Per-endpoint latency, SQL statements per request and time spent in the recommendation
+# and search stages, served in Prometheus text format by /metrics.
+metrics_registry = Registry()
+REQUEST_SECONDS = metrics_registry.histogram('http_request_duration_seconds', 'Time to build the response', ['endpoint', 'method', 'status'])
+REQUEST_SQL_QUERIES = metrics_registry.histogram('http_request_sql_queries', 'SQL statements executed per request', ['endpoint'], buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100))
+REQUEST_SQL_SECONDS = metrics_registry.histogram('http_request_sql_duration_seconds', 'Time spent in SQL per request', ['endpoint'])
+STAGE_SECONDS = metrics_registry.histogram('app_stage_duration_seconds', 'Time spent in a stage of a request', ['stage'])
+# Opt-in: PROFILE_SLOW_REQUESTS=1 samples stacks and writes flame-graph input for requests slower than PROFILE_THRESHOLD_MS
+profiler = SamplingProfiler(os.getenv('PROFILE_DIR', 'profiles'), threshold_ms=float(os.getenv('PROFILE_THRESHOLD_MS', '500')), interval_ms=float(os.getenv('PROFILE_INTERVAL_MS', '5')))
+if os.getenv('PROFILE_SLOW_REQUESTS', '0') == '1': profiler.enable()
+
+@metrics_registry.collector
+def cache_metrics():
+    stats = {('response',): response_cache.stats()}
+    for name, cache in [('book', book_cache), ('fallback', fallback_cache)]:
+        stats[(name,)] = {"hits": cache.hits, "misses": cache.misses, "evictions": cache.evictions}
+    return [(f'cache_{counter}_total', f'Cache {counter}', 'counter', ['cache'], {labels: s.get(counter) for labels, s in stats.items()})
+            for counter in ('hits', 'misses', 'evictions')]
+
+@metrics_registry.collector
+def mail_metrics():
+    return [('mail_messages_total', 'Outgoing e-mails by outcome', 'counter', ['outcome'], {(o,): getattr(mail_queue, o) for o in ('sent', 'retried', 'failed')}),
+            ('mail_queue_pending', 'E-mails waiting or being sent', 'gauge', [], {(): mail_queue.pending()})]
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def sql_started(conn, cursor, statement, parameters, context, executemany):
+    context.instrumentation_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def sql_finished(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'sql_queries' in g:
+        g.sql_queries += 1
+        g.sql_seconds += time.perf_counter() - context.instrumentation_started
 
 # --- 5. Database Models ---
 class User(db.Model):
@@ -66,15 +171,20 @@ class Rating(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     book_title = db.Column(db.Text, nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), index=True) # Filled by /rate; `flask backfill-book-ids` for older rows
     rating = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True) # Watermark for incremental_updater.py
+    __table_args__ = (db.Index('ix_rating_user_book', 'user_id', 'book_id'),) # /rate, /my-ratings
 
 class Review(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     book_title = db.Column(db.Text, nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), index=True) # Filled by /submit-review; `flask backfill-book-ids` for older rows
     description_text = db.Column(db.Text, nullable=False) # The user's detailed description
     is_approved = db.Column(db.Boolean, default=False, nullable=False) # <-- MODERATION FLAG
     timestamp = db.Column(db.DateTime, default=datetime.utcnow) # For sorting/display
+    __table_args__ = (db.Index('ix_review_book_approved', 'book_id', 'is_approved'),) # /reviews/<title>
 class Book(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     isbn = db.Column(db.String(40), unique=True, nullable=False)
@@ -85,47 +195,437 @@ class Book(db.Model):
     image_url_m = db.Column(db.Text)
     genre = db.Column(db.String(100))
     price = db.Column(db.Float)
+    # GIN trigram indexes serve /search's ILIKE '%term%' on Postgres (needs `flask enable-search-extensions` first)
+    __table_args__ = (
+        db.Index('ix_book_title_trgm', 'title', postgresql_using='gin', postgresql_ops={'title': 'gin_trgm_ops'}),
+        db.Index('ix_book_author_trgm', 'author', postgresql_using='gin', postgresql_ops={'author': 'gin_trgm_ops'}),
+    )
+
+class BookRatingStats(db.Model):
+    # Per-book rating aggregates kept in step by /rate, so /search doesn't group the ratings table
+    __tablename__ = 'book_rating_stats'
+    book_id = db.Column(db.Integer, db.ForeignKey('book.id'), primary_key=True)
+    rating_sum = db.Column(db.BigInteger, default=0, nullable=False)
+    rating_count = db.Column(db.Integer, default=0, nullable=False)
+    avg_rating = db.Column(db.Float, default=0, nullable=False)
+
+class OtpCode(db.Model):
+    # Pending one-time codes, shared by every worker (see otp_store.py)
+    __tablename__ = 'otp_code'
+    key = db.Column(db.String(120), primary_key=True) # "verify:<username>" or "reset:<username>"
+    code = db.Column(db.String(12)) # NULL once used or locked
+    expires_at = db.Column(db.DateTime, index=True)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    issued = db.Column(db.Integer, default=0, nullable=False) # codes sent since window_started
+    window_started = db.Column(db.DateTime, nullable=False)
 
-otp_storage = {}
+# OTP_STORE: 'sql' (default, shared), 'memory' (single process) or a redis:// URL
+otp_store = make_otp_store(os.getenv('OTP_STORE', 'sql'), db.session, OtpCode)
 # --- 6. Custom Decorators & Helper Functions ---
 def admin_required():
     def wrapper(fn):
         @wraps(fn)
         @jwt_required()
         def decorator(*args, **kwargs):
-            current_user_username = get_jwt_identity()
-            user = User.query.filter_by(username=current_user_username).first()
-            if not user or not user.is_admin:
+            # Trusts the token's is_admin claim: a revoked admin keeps access until the token expires
+            identity = current_identity()
+            if not identity or not identity["is_admin"]:
                 return jsonify(msg="Admins only! Access denied."), 403
             return fn(*args, **kwargs)
         return decorator
     return wrapper
 
-def recommend(book_isbn):
-    clean_isbn = str(book_isbn).strip()
-    try:
-        index = pivot_table.index.get_loc(clean_isbn)
-        similar_items = sorted(list(enumerate(similarity_scores[index])), key=lambda x: x[1], reverse=True)[1:6]
-        recommendations = []
-        for i in similar_items:
-            recommended_isbn = str(pivot_table.index[i[0]]).strip()
-            book_info = Book.query.filter_by(isbn=recommended_isbn).first()
-            if book_info:
-                recommendations.append({"title": book_info.title, "author": book_info.author, "image": book_info.image_url_m.replace("http://", "https://") if book_info.image_url_m else "", "genre": book_info.genre, "price": book_info.price, "isbn": book_info.isbn})
-        return recommendations
-    except KeyError:
-        book = Book.query.filter_by(isbn=clean_isbn).first()
+def identity_claims(user):
+    return {"user_id": user.id, "is_admin": bool(user.is_admin)}
+
+def current_identity():
+    # {"user_id", "is_admin"} of the caller from the token claims, memoized for the request;
+    # None without a token or for a token whose user no longer exists
+    if 'identity' not in g:
+        claims = get_jwt()
+        if 'user_id' in claims:
+            g.identity = {"user_id": claims["user_id"], "is_admin": claims.get("is_admin", False)}
+        else:
+            username = get_jwt_identity()
+            g.identity = identity_cache.get(username) if username else None
+            if username and g.identity is None:
+                user = User.query.filter_by(username=username).first()
+                g.identity = identity_claims(user) if user else None
+                if user: identity_cache.set(username, g.identity)
+    return g.identity
+
+def current_user_id():
+    identity = current_identity()
+    return identity["user_id"] if identity else None
+
+def current_user():
+    # The caller's User row, for endpoints that read or change more than the claims;
+    # one primary-key lookup per request
+    if 'current_user' not in g:
+        user_id = current_user_id()
+        g.current_user = db.session.get(User, user_id) if user_id is not None else None
+    return g.current_user
+
+def user_rating_map(user_id):
+    # {book_id: rating} for /search, cached per user between /rate calls
+    ratings = rating_map_cache.get(user_id)
+    if ratings is None:
+        ratings = dict(db.session.query(Rating.book_id, Rating.rating).filter(Rating.user_id == user_id).all())
+        rating_map_cache.set(user_id, ratings)
+    return ratings
+
+def find_book(title=None, isbn=None):
+    # Requests identify books by ISBN when they can, otherwise by title (first Book with that title)
+    if isbn: return Book.query.filter_by(isbn=str(isbn).strip()).first()
+    if title: return Book.query.filter_by(title=title).order_by(Book.id).first()
+    return None
+
+def book_to_dict(b):
+    return {"title": b.title, "author": b.author, "image": b.image_url_m.replace("http://", "https://") if b.image_url_m else "", "genre": b.genre, "price": b.price, "isbn": b.isbn}
+
+def hydrate_books(isbns):
+    # Book metadata for `isbns` in the given order, from book_cache plus at most one IN (...) query.
+    cached = book_cache.get_many(isbns)
+    missing = list(dict.fromkeys(i for i in isbns if i not in cached))
+    if missing:
+        found = {b.isbn: book_to_dict(b) for b in Book.query.filter(Book.isbn.in_(missing)).all()}
+        for isbn in missing:
+            cached[isbn] = found.get(isbn)
+            book_cache.set(isbn, cached[isbn])
+    return [cached[i] for i in isbns if cached.get(i)]
+
+def content_fallback(clean_isbn):
+    # Same author first, then same genre, for books added to the catalog after the model was
+    # built (the others are answered by the content index); the picks are cached.
+    rec_isbns = fallback_cache.get(clean_isbn)
+    if rec_isbns is None:
+        book = hydrate_books([clean_isbn])
         if not book: return []
-        recs = Book.query.filter(Book.author == book.author, Book.isbn != book.isbn).limit(5).all()
+        book = book[0]
+        recs = Book.query.filter(Book.author == book["author"], Book.isbn != book["isbn"]).limit(5).all()
         if len(recs) < 5:
-            existing_titles = [r.title for r in recs] + [book.title]
+            existing_titles = [r.title for r in recs] + [book["title"]]
             needed = 5 - len(recs)
-            genre_recs = Book.query.filter(Book.genre == book.genre, ~Book.title.in_(existing_titles)).limit(needed).all()
+            genre_recs = Book.query.filter(Book.genre == book["genre"], ~Book.title.in_(existing_titles)).limit(needed).all()
             recs.extend(genre_recs)
-        return [{"title": b.title, "author": b.author, "image": b.image_url_m.replace("http://", "https://") if b.image_url_m else "", "genre": b.genre, "price": b.price, "isbn": b.isbn} for b in recs]
+        for b in recs: book_cache.set(b.isbn, book_to_dict(b))
+        rec_isbns = [b.isbn for b in recs]
+        fallback_cache.set(clean_isbn, rec_isbns)
+    return hydrate_books(rec_isbns)
+
+def recommended_isbns(clean_isbn):
+    # Exact precomputed neighbors first, then the ANN index over the wider catalog, then the
+    # content index. Only reads the model artifacts; None when the database has to answer.
+    try:
+        with STAGE_SECONDS.time('recommend.neighbors'):
+            return [isbn for isbn, score in neighbor_index.neighbors(clean_isbn, 5)]
+    except KeyError:
+        pass
+    if ann_index is not None and clean_isbn in ann_index:
+        with STAGE_SECONDS.time('recommend.ann'):
+            return [isbn for isbn, score in ann_index.neighbors(clean_isbn, 5, ANN_NPROBE)]
+    if content_index is not None and clean_isbn in content_index:
+        with STAGE_SECONDS.time('recommend.content_index'):
+            return content_index.similar(clean_isbn, 5)
+    return None
+
+def recommend(book_isbn):
+    clean_isbn = str(book_isbn).strip()
+    isbns = recommended_isbns(clean_isbn)
+    if isbns is None:
+        with STAGE_SECONDS.time('recommend.content_fallback'):
+            return content_fallback(clean_isbn)
+    with STAGE_SECONDS.time('recommend.hydrate_books'):
+        return hydrate_books(isbns)
+
+MAX_BATCH_ISBNS = 100
+
+def recommend_many(book_isbns, n=5):
+    # Recommendations for several ISBNs at once: one gathered similarity submatrix,
+    # one argpartition over its rows and a single metadata query for every neighbor,
+    # including the ANN/content-index picks for books outside the item-item model.
+    clean_isbns = list(dict.fromkeys(str(i).strip() for i in book_isbns))
+    rows = model.isbn_map.lookup(clean_isbns)
+    known = rows >= 0
+    neighbor_isbns = {}
+    if known.any():
+        known_rows = rows[known]
+        if model.similarity is not None:
+            ids, _ = top_k_neighbors(np.asarray(model.similarity[known_rows]), n, exclude=known_rows)
+        else:
+            # Sparse builds may not ship the dense matrix; the neighbor index rows are already top-K.
+            ids = np.asarray(neighbor_index.neighbor_ids[known_rows, :n])
+        for isbn, row_ids in zip(np.asarray(clean_isbns)[known], ids):
+            neighbor_isbns[str(isbn)] = [str(model.isbns[i]) for i in row_ids]
+    # Books outside the item-item model: ANN or content-index picks, read from the artifacts
+    for isbn in clean_isbns:
+        if isbn not in neighbor_isbns:
+            picks = recommended_isbns(isbn)
+            if picks is not None: neighbor_isbns[isbn] = picks
+    books = {b["isbn"]: b for b in hydrate_books([i for isbns in neighbor_isbns.values() for i in isbns])}
+    results = {isbn: [books[i] for i in isbns if i in books] for isbn, isbns in neighbor_isbns.items()}
+    # Only books added after the model was built still need their own queries
+    for isbn in clean_isbns:
+        if isbn not in results:
+            with STAGE_SECONDS.time('recommend.content_fallback'):
+                results[isbn] = content_fallback(isbn)
+    return {isbn: results[isbn] for isbn in clean_isbns}
+
+def book_popularity(isbns):
+    # {isbn: (rating_count, avg_rating)} from popularity_cache plus at most one query; (0, 0) when unrated
+    cached = popularity_cache.get_many(isbns)
+    missing = list(dict.fromkeys(i for i in isbns if i not in cached))
+    if missing:
+        found = {isbn: (count, avg) for isbn, count, avg in db.session.query(Book.isbn, BookRatingStats.rating_count, BookRatingStats.avg_rating).join(BookRatingStats, Book.id == BookRatingStats.book_id).filter(Book.isbn.in_(missing))}
+        for isbn in missing:
+            cached[isbn] = found.get(isbn, (0, 0.0))
+            popularity_cache.set(isbn, cached[isbn])
+    return cached
+
+def popular_isbns(genre, n):
+    # The n most rated books of a genre ('all' for the whole catalog)
+    isbns = popular_cache.get((genre, n))
+    if isbns is None:
+        query = db.session.query(Book.isbn).join(BookRatingStats, Book.id == BookRatingStats.book_id).filter(BookRatingStats.rating_count > 0)
+        if genre != 'all': query = query.filter(Book.genre == genre)
+        isbns = [isbn for isbn, in query.order_by(BookRatingStats.rating_count.desc(), Book.id).limit(n)]
+        popular_cache.set((genre, n), isbns)
+    return isbns
+
+def isbns_for_titles(titles):
+    # The first Book with each title, like find_book(); titles not in the catalog are dropped
+    found = {}
+    for isbn, title in db.session.query(Book.isbn, Book.title).filter(Book.title.in_(titles)).order_by(Book.id):
+        found.setdefault(title, isbn)
+    return [found[t] for t in titles if t in found]
+
+def hybrid_recommend(book_isbn, genre='all', max_price=None, n=5, budget_ms=HYBRID_BUDGET_MS):
+    # Candidates from the item-item neighbors (or ANN), the content postings, the SVD factors and the
+    # most rated books, blended by hybrid_ranker.rank() under the /search filters. Content, SVD and
+    # popularity are skipped once budget_ms is spent. Returns (books with their score, skipped stages).
+    budget = Budget(budget_ms)
+    clean_isbn = str(book_isbn).strip()
+    seed = hydrate_books([clean_isbn])
+    if not seed: return [], budget.skipped
+    seed = seed[0]
+    with STAGE_SECONDS.time('hybrid.cf'):
+        cf = {}
+        if clean_isbn in neighbor_index: cf = dict(neighbor_index.neighbors(clean_isbn, HYBRID_CANDIDATES))
+        elif ann_index is not None and clean_isbn in ann_index: cf = dict(ann_index.neighbors(clean_isbn, HYBRID_CANDIDATES, ANN_NPROBE))
+    candidates = list(cf)
+    if budget.allows('content'):
+        with STAGE_SECONDS.time('hybrid.content'):
+            if content_index is not None and clean_isbn in content_index: candidates += content_index.similar(clean_isbn, HYBRID_CANDIDATES)
+            else: candidates += [b["isbn"] for b in content_fallback(clean_isbn)]
+    use_svd = svd_model is not None and seed["title"] in svd_model.row_of and budget.allows('svd')
+    if use_svd:
+        with STAGE_SECONDS.time('hybrid.svd'):
+            candidates += isbns_for_titles([title for title, score in svd_model.similar_items(seed["title"], HYBRID_CANDIDATES)])
+    use_popularity = budget.allows('popularity')
+    if use_popularity:
+        with STAGE_SECONDS.time('hybrid.popularity'):
+            candidates += popular_isbns(genre if genre != 'all' else seed["genre"] or 'all', HYBRID_CANDIDATES)
+    with STAGE_SECONDS.time('hybrid.hydrate_books'):
+        books = hydrate_books([i for i in dict.fromkeys(candidates) if i != clean_isbn])
+    if not books: return [], budget.skipped
+    isbns = [b["isbn"] for b in books]
+    signals = {"cf": lookup_scores(isbns, cf), "content": content_affinity(seed, books)}
+    if use_svd: signals["svd"] = svd_model.item_similarity(seed["title"], [b["title"] for b in books])
+    if use_popularity:
+        stats = book_popularity(isbns)
+        signals["popularity"] = popularity([stats[i][0] for i in isbns], [stats[i][1] for i in isbns])
+    with STAGE_SECONDS.time('hybrid.rank'):
+        ids, scores = rank(signal_matrix(len(books), **signals), HYBRID_WEIGHTS, filter_mask(books, genre, max_price), n)
+    return [dict(books[i], score=round(float(s), 4)) for i, s in zip(ids, scores)], budget.skipped
+
+STATS_UPSERTS = {'postgresql': pg_insert, 'sqlite': sqlite_insert}
+
+def apply_rating_to_stats(book_id, delta_sum, delta_count):
+    # One atomic INSERT ... ON CONFLICT DO UPDATE, so concurrent /rate calls can't lose increments
+    # or collide on the first rating of a book
+    upsert = STATS_UPSERTS.get(db.session.get_bind().dialect.name)
+    if upsert is None:
+        raise RuntimeError(f"Rating stats need Postgres or SQLite, not {db.session.get_bind().dialect.name}.")
+    table = BookRatingStats.__table__
+    stmt = upsert(table).values(book_id=book_id, rating_sum=delta_sum, rating_count=delta_count,
+                                avg_rating=delta_sum / delta_count if delta_count else 0)
+    new_sum, new_count = table.c.rating_sum + stmt.excluded.rating_sum, table.c.rating_count + stmt.excluded.rating_count
+    db.session.execute(stmt.on_conflict_do_update(index_elements=['book_id'], set_={
+        'rating_sum': new_sum,
+        'rating_count': new_count,
+        'avg_rating': case((new_count > 0, new_sum * 1.0 / new_count), else_=0),
+    }))
+
+def rebuild_rating_stats():
+    # Full backfill from the ratings table (e.g. after bulk imports or on first deploy).
+    BookRatingStats.query.delete()
+    aggregates = db.session.query(Rating.book_id, func.sum(Rating.rating), func.count(Rating.rating)).filter(Rating.book_id.isnot(None)).group_by(Rating.book_id)
+    db.session.bulk_insert_mappings(BookRatingStats, [{"book_id": book_id, "rating_sum": total, "rating_count": count, "avg_rating": total / count} for book_id, total, count in aggregates])
+    db.session.commit()
+
+@app.cli.command('rebuild-rating-stats')
+def rebuild_rating_stats_command():
+    """Recompute book_rating_stats from the ratings table."""
+    rebuild_rating_stats()
+    print(f"Rebuilt rating stats for {BookRatingStats.query.count()} books.")
+
+# Used instead of pg_trgm when the database isn't Postgres; filled on first search, kept current by /admin/add-book
+local_search_index = LocalSearchIndex()
+
+def find_books(search_term, genre, max_price, after, limit):
+    # One page of (Book, avg_rating, rating_count) ordered by relevance, then id, plus the next keyset cursor.
+    query = db.session.query(Book, BookRatingStats.avg_rating, BookRatingStats.rating_count).outerjoin(BookRatingStats, Book.id == BookRatingStats.book_id)
+    if search_term and db.engine.dialect.name != 'postgresql':
+        if not local_search_index.loaded:
+            local_search_index.load(db.session.query(Book.id, Book.title, Book.author, Book.genre, Book.price))
+        page, next_cursor = local_search_index.search(search_term, None if genre == 'all' else genre, max_price, after, limit)
+        rows = {b.id: (b, avg, count) for b, avg, count in query.filter(Book.id.in_([book_id for _, book_id in page]))}
+        return [rows[book_id] for _, book_id in page if book_id in rows], next_cursor
+    if genre != 'all': query = query.filter(Book.genre == genre)
+    query = query.filter(Book.price <= max_price)
+    if search_term:
+        # Served by the GIN pg_trgm indexes on title and author; similarity() gives the ranking
+        pattern = f'%{search_term}%'
+        rank = func.round(func.greatest(func.similarity(Book.title, search_term), func.similarity(Book.author, search_term)).cast(db.Numeric), 6)
+        query = query.filter(or_(Book.title.ilike(pattern), Book.author.ilike(pattern))).add_columns(rank.label('rank'))
+        if after: query = query.filter(or_(rank < after[0], and_(rank == after[0], Book.id > after[1])))
+        query = query.order_by(rank.desc(), Book.id)
+    else:
+        query = query.add_columns(literal(0.0).label('rank'))
+        if after: query = query.filter(Book.id > after[1])
+        query = query.order_by(Book.id)
+    rows = query.limit(limit + 1).all()
+    next_cursor = encode_cursor(float(rows[limit - 1].rank), rows[limit - 1][0].id) if len(rows) > limit else None
+    return [(b, avg, count) for b, avg, count, _ in rows[:limit]], next_cursor
+
+def backfill_book_ids(model, batch_size):
+    # Point rows written before book_id existed at the first Book with their title. Walks the
+    # primary key in fixed-size ranges and commits each one, so it can run online on large tables.
+    first_book_id = db.session.query(func.min(Book.id)).filter(Book.title == model.book_title).correlate(model).scalar_subquery()
+    low, high = db.session.query(func.min(model.id), func.max(model.id)).one()
+    filled = 0
+    for start in range(low or 0, (high or -1) + 1, batch_size):
+        result = db.session.execute(model.__table__.update().where(model.id >= start, model.id < start + batch_size, model.book_id.is_(None)).values(book_id=first_book_id))
+        db.session.commit()
+        filled += result.rowcount
+        print(f"{model.__tablename__}: ids {start}-{start + batch_size - 1} done, {filled} rows linked so far")
+    return filled
+
+@app.cli.command('backfill-book-ids')
+@click.option('--batch-size', default=5000, show_default=True)
+def backfill_book_ids_command(batch_size):
+    """Fill rating.book_id and review.book_id from their titles, in batches."""
+    for model in (Rating, Review):
+        backfill_book_ids(model, batch_size)
+    rebuild_rating_stats()
+
+@app.cli.command('evict-otp-codes')
+def evict_otp_codes_command():
+    """Delete OTP rows whose code and issue window have both expired (run periodically, e.g. from cron)."""
+    if not isinstance(otp_store, SqlOtpStore):
+        print("OTP_STORE is not 'sql'; Redis and in-memory codes are evicted by the store itself.")
+        return
+    print(f"Evicted {otp_store.evict()} expired OTP rows.")
+
+@app.cli.command('enable-search-extensions')
+def enable_search_extensions_command():
+    """Install pg_trgm, required by the trigram search indexes (run before `flask db upgrade`)."""
+    if db.engine.dialect.name != 'postgresql':
+        print("Not a Postgres database; /search uses the in-process index instead.")
+        return
+    db.session.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+    db.session.commit()
+    print("pg_trgm enabled.")
+
+# Rows fetched per round trip when streaming a full listing, and rows per chunk written to the client
+STREAM_BATCH_SIZE = 1000
+STREAM_CHUNK_ROWS = 100
+
+def paginated_json(query, id_column, serialize):
+    # Keyset pagination over `id_column` when ?limit= is given (next page cursor in X-Next-Cursor);
+    # without it, the whole listing is streamed as a JSON array in STREAM_BATCH_SIZE batches.
+    try: after = decode_cursor(request.args.get('cursor'))
+    except ValueError: return jsonify({"msg": "Invalid cursor"}), 400
+    if after: query = query.filter(id_column > after[1])
+    if request.args.get('limit'):
+        try: limit = max(1, min(int(request.args['limit']), MAX_SEARCH_PAGE_SIZE))
+        except ValueError: return jsonify({"msg": "Invalid limit"}), 400
+        rows = query.limit(limit + 1).all()
+        response = jsonify([serialize(row) for row in rows[:limit]])
+        if len(rows) > limit: response.headers['X-Next-Cursor'] = encode_cursor(0, rows[limit - 1].id)
+        return response
+    def generate():
+        try:
+            yield '['
+            parts = []
+            for i, row in enumerate(query.execution_options(yield_per=STREAM_BATCH_SIZE)):
+                parts.append((',' if i else '') + json.dumps(serialize(row)))
+                if len(parts) == STREAM_CHUNK_ROWS:
+                    yield ''.join(parts)
+                    parts = []
+            yield ''.join(parts) + ']'
+        finally:
+            # The query belongs to the view's session, which was already removed when the view
+            # returned; close it here or its connection stays checked out until garbage collection
+            query.session.close()
+    return Response(stream_with_context(generate()), mimetype='application/json')
 
 PASSWORD_REGEX = re.compile(r"^(?=.*[0-9])(?=.*[^A-Za-z0-9]).{6,}$")
 
+def endpoint_label():
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.sql_queries, g.sql_seconds = 0, 0.0
+    profiler.start_request()
+
+# Endpoints that never write; with DATABASE_REPLICA_URL set their queries go to the replica
+READ_ONLY_ENDPOINTS = {'search_books', 'get_my_ratings', 'get_approved_reviews', 'get_recommendations', 'get_batch_recommendations', 'get_hybrid_recommendations'}
+
+@app.before_request
+def route_reads_to_replica():
+    g.use_replica = False
+    if REPLICA_BIND not in app.config['SQLALCHEMY_BINDS'] or request.endpoint not in READ_ONLY_ENDPOINTS: return
+    try:
+        # The view's @jwt_required checks the token again and reports errors; here a bad token is anonymous
+        verify_jwt_in_request(optional=True)
+        user_id = current_user_id()
+    except (JWTExtendedException, PyJWTError):
+        user_id = None
+    g.use_replica = user_id is None or not primary_pins.is_pinned(user_id)
+
+@app.after_request
+def record_request_metrics(response):
+    # Streamed bodies (paginated_json) are generated after this point and are not included
+    elapsed = time.perf_counter() - g.request_started
+    endpoint = endpoint_label()
+    REQUEST_SECONDS.observe(elapsed, endpoint, request.method, str(response.status_code))
+    REQUEST_SQL_QUERIES.observe(g.sql_queries, endpoint)
+    REQUEST_SQL_SECONDS.observe(g.sql_seconds, endpoint)
+    response.headers['Server-Timing'] = f'app;dur={elapsed * 1000:.1f}, db;dur={g.sql_seconds * 1000:.1f};desc="{g.sql_queries} queries"'
+    return response
+
+@app.teardown_request
+def finish_request_profile(exc):
+    if 'request_started' in g:
+        profiler.end_request(endpoint_label(), time.perf_counter() - g.request_started)
+
+@app.before_request
+def reload_model_if_published():
+    # Hot-swap to a version published by model_builder.py or incremental_updater.py, no restart needed
+    global model, neighbor_index, svd_model, content_index, ann_index, model_checked_at
+    if time.monotonic() - model_checked_at < MODEL_RELOAD_INTERVAL: return
+    model_checked_at = time.monotonic()
+    if not model.is_stale(): return
+    new_model = ModelArtifacts(MODEL_DIR)
+    model, neighbor_index, svd_model = new_model, new_model.neighbor_index, SvdModel.load(new_model.path)
+    content_index, ann_index = ContentIndex.load(new_model.path), AnnIndex.load(new_model.path)
+    fallback_cache.clear()
+    response_cache.invalidate('recommend')
+    response_cache.invalidate('search')
+
 # --- 7. API Endpoints ---
 @app.route('/register', methods=['POST'])
 def register():
@@ -151,7 +651,7 @@ def login():
     username, password = data.get('username'), data.get('password')
     user = User.query.filter_by(username=username).first()
     if user and check_password_hash(user.password_hash, password):
-        access_token = create_access_token(identity=username)
+        access_token = create_access_token(identity=username, additional_claims=identity_claims(user))
         return jsonify(access_token=access_token)
     return jsonify({"msg": "Bad username or password"}), 401
 
@@ -159,30 +659,36 @@ def login():
 @app.route('/search', methods=['GET'])
 @jwt_required(optional=True)
 def search_books():
-    current_user_username = get_jwt_identity()
-    user_ratings_map = {}
-    if current_user_username:
-        user = User.query.filter_by(username=current_user_username).first()
-        if user:
-            user_ratings = Rating.query.filter_by(user_id=user.id).all()
-            user_ratings_map = {r.book_title: r.rating for r in user_ratings}
-    search_term = request.args.get('q', '').lower()
+    user_id = current_user_id()
+    user_ratings_map = user_rating_map(user_id) if user_id is not None else {}
+    search_term = request.args.get('q', '').lower().strip()
     genre = request.args.get('genre', 'all')
     max_price = float(request.args.get('price', '40'))
-    query = db.session.query(Book, func.avg(Rating.rating).label('average_rating'), func.count(Rating.rating).label('rating_count')).outerjoin(Rating, Book.title == Rating.book_title).group_by(Book.id)
-    if search_term: query = query.filter(Book.title.ilike(f'%{search_term}%'))
-    if genre != 'all': query = query.filter(Book.genre == genre)
-    query = query.filter(Book.price <= max_price)
-    filtered_books = query.limit(100).all()
-    results = [{"title": b.title, "author": b.author, "image": b.image_url_m.replace("http://", "https://") if b.image_url_m else "", "genre": b.genre, "price": b.price, "isbn": b.isbn, "average_rating": round(avg, 1) if avg else 0, "rating_count": count, "user_rating": user_ratings_map.get(b.title, 0)} for b, avg, count in filtered_books]
-    return jsonify(results)
+    try: limit = max(1, min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), MAX_SEARCH_PAGE_SIZE))
+    except ValueError: return jsonify({"msg": "Invalid limit"}), 400
+    try: after = decode_cursor(request.args.get('cursor'))
+    except ValueError: return jsonify({"msg": "Invalid cursor"}), 400
+    # The cached page is shared by every user; user_rating is merged in afterwards
+    key = response_key(model.version, search_term, genre, max_price, limit, request.args.get('cursor'))
+    page = response_cache.get('search', key)
+    if page is None:
+        with STAGE_SECONDS.time('search.find_books'):
+            filtered_books, next_cursor = find_books(search_term, genre, max_price, after, limit)
+        page = {"books": [[b.id, {"title": b.title, "author": b.author, "image": b.image_url_m.replace("http://", "https://") if b.image_url_m else "", "genre": b.genre, "price": b.price, "isbn": b.isbn, "average_rating": round(avg, 1) if avg else 0, "rating_count": count or 0}] for b, avg, count in filtered_books], "next_cursor": next_cursor}
+        response_cache.set('search', key, page)
+    results = [dict(book, user_rating=user_ratings_map.get(book_id, 0)) for book_id, book in page["books"]]
+    with STAGE_SECONDS.time('search.serialize'):
+        response = jsonify(results)
+    if page["next_cursor"]: response.headers['X-Next-Cursor'] = page["next_cursor"]
+    return response
 # In backend/app.py, replace the entire upload_profile_photo function
 
 @app.route('/upload-profile-photo', methods=['POST'])
 @jwt_required()
 def upload_profile_photo():
-    current_user_username = get_jwt_identity()
-    user = User.query.filter_by(username=current_user_username).first()
+    user_id = current_user_id()
+    # Bodies over the cap are rejected with 413 while they are read, before anything is buffered
+    request.max_content_length = PHOTO_MAX_BYTES
 
     # CRITICAL: We look for the file under the key 'file' from the frontend FormData
     if 'file' not in request.files:
@@ -191,91 +697,94 @@ def upload_profile_photo():
     file = request.files['file']
     if file.filename == '':
         return jsonify(msg="No selected file."), 400
-    
-    if file:
-        # Generate a unique filename (e.g., user_123_timestamp.jpg)
-        filename = secure_filename(f"user_{user.id}_{int(time.time())}.{file.filename.rsplit('.', 1)[1].lower()}")
-        bucket_name = "Profile Photo" # Your specified bucket name
-        file_path = f"{user.username}/{filename}" # Path within the bucket
 
-        try:
-            # 1. Read file data into memory
-            file_data = file.read()
-            
-            # 2. Upload to Supabase Storage
-            supabase.storage.from_(bucket_name).upload(
-                file=file_data, 
-                path=file_path,
-                file_options={"content-type": file.mimetype} 
-            )
-            
-            # 3. Get the public URL
-            # The URL is constructed using the base project URL and the path
-            public_url = f"{SUPABASE_URL}/storage/v1/object/public/{bucket_name}/{file_path}"
-
-            # 4. Save the permanent public URL to the database
-            user.profile_photo_url = public_url
+    # Werkzeug has already spooled the upload; copy it in chunks to a file the pipeline owns
+    extension = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else 'jpg'
+    fd, upload_path = tempfile.mkstemp(prefix='upload-', suffix=f".{secure_filename(extension)}")
+    os.close(fd)
+    file.save(upload_path)
+    try:
+        probe_photo(upload_path)
+    except InvalidPhoto as e:
+        os.remove(upload_path)
+        return jsonify(msg=str(e)), 400
+
+    # Generate a unique filename (e.g., user_123_timestamp.jpg)
+    stem = secure_filename(f"user_{user_id}_{int(time.time())}")
+    # Folder by user id: usernames are free text and must not become path segments
+    file_path, thumb_path = photo_paths(f"user_{user_id}", stem, secure_filename(extension))
+    public_url = photo_storage.public_url(file_path)
+
+    def save_photo_url():
+        # Runs on a pipeline thread once the photo is stored
+        with app.app_context():
+            User.query.filter_by(id=user_id).update({"profile_photo_url": public_url})
             db.session.commit()
 
-            return jsonify(msg="Photo updated and saved successfully.", profile_photo_url=public_url), 200
-
-        except Exception as e:
-            print(f"SUPABASE UPLOAD FAILED: {e}")
-            return jsonify(msg=f"Failed to upload to cloud storage. Check policies."), 500
-
-        # 2. Get the public URL for the image
-        # Assuming your bucket policy allows public access for reading.
-        # This URL is what is saved in the database.
-        
-        # --- IMPORTANT: Get the public URL based on Supabase Project URL ---
-        public_url = f"{SUPABASE_URL}/storage/v1/object/public/{bucket_name}/{file_path}"
-        
-        # 3. Update the database with the new permanent URL
-        user.profile_photo_url = public_url
-        db.session.commit()
+    photo_pipeline.submit(upload_path, file_path, thumb_path, file.mimetype, save_photo_url)
+    return jsonify(msg="Photo received and is being processed.", profile_photo_url=public_url,
+                   thumbnail_url=photo_storage.public_url(thumb_path) if thumb_path else None), 202
 
-        return jsonify(msg="Photo updated successfully.", profile_photo_url=public_url), 200
+@app.errorhandler(413)
+def payload_too_large(e):
+    return jsonify(msg=f"File is too large (max {PHOTO_MAX_BYTES // (1024 * 1024)} MB)."), 413
+
+if STORAGE_BACKEND == 'local':
+    @app.route('/media/<path:path>', methods=['GET'])
+    def local_media(path):
+        # Serves uploads stored by the local storage backend
+        return send_from_directory(os.path.abspath(LOCAL_STORAGE_DIR), path)
 
 @app.route('/rate', methods=['POST'])
 @jwt_required()
 def rate_book():
-    current_user_username = get_jwt_identity()
-    user = User.query.filter_by(username=current_user_username).first()
+    user = current_user()
     if not user.is_verified: return jsonify(msg="Email not verified. Please verify your email to rate books."), 403
     data = request.get_json()
     book_title, rating = data.get('title'), data.get('rating')
-    existing_rating = Rating.query.filter_by(user_id=user.id, book_title=book_title).first()
-    if existing_rating: existing_rating.rating = rating
-    else: db.session.add(Rating(user_id=user.id, book_title=book_title, rating=rating))
+    book = find_book(book_title, data.get('isbn'))
+    if not book: return jsonify(msg="Book not found."), 404
+    book_title = book.title
+    existing_rating = Rating.query.filter_by(user_id=user.id, book_id=book.id).first()
+    if existing_rating:
+        apply_rating_to_stats(book.id, int(rating) - existing_rating.rating, 0)
+        existing_rating.rating = rating
+    else:
+        db.session.add(Rating(user_id=user.id, book_id=book.id, book_title=book_title, rating=rating))
+        apply_rating_to_stats(book.id, int(rating), 1)
     db.session.commit()
+    primary_pins.pin(user.id)
+    rating_map_cache.delete(user.id)
+    # Cached /search pages carry this book's average_rating and rating_count
+    response_cache.invalidate('search')
     return jsonify({"msg": f"Successfully rated '{book_title}' with {rating}"})
 
 @app.route('/my-ratings', methods=['GET'])
 @jwt_required()
 def get_my_ratings():
-    current_user_username = get_jwt_identity()
-    user = User.query.filter_by(username=current_user_username).first()
-    user_ratings = Rating.query.filter_by(user_id=user.id).all()
-    rated_books_details = []
-    for r in user_ratings:
-        book_info = Book.query.filter_by(title=r.book_title).first()
-        if book_info: rated_books_details.append({"title": r.book_title, "author": book_info.author, "image": book_info.image_url_m.replace("http://", "https://") if book_info.image_url_m else "", "isbn": book_info.isbn, "user_rating": r.rating})
-    return jsonify(rated_books_details)
+    user_id = current_user_id()
+    # One query joining each rating to its Book through the indexed book_id
+    query = db.session.query(Rating.id, Rating.book_title, Rating.rating, Book.author, Book.image_url_m, Book.isbn).join(Book, Book.id == Rating.book_id).filter(Rating.user_id == user_id).order_by(Rating.id)
+    def serialize(row):
+        return {"title": row.book_title, "author": row.author, "image": row.image_url_m.replace("http://", "https://") if row.image_url_m else "", "isbn": row.isbn, "user_rating": row.rating}
+    return paginated_json(query, Rating.id, serialize)
 @app.route('/submit-review', methods=['POST'])
 @jwt_required()
 def submit_review():
-    current_user_username = get_jwt_identity()
-    user = User.query.filter_by(username=current_user_username).first()
     data = request.get_json()
     title, description = data.get('title'), data.get('description')
 
     if not title or not description:
         return jsonify(msg="Book title and review description are required."), 400
+    book = find_book(title, data.get('isbn'))
+    if not book:
+        return jsonify(msg="Book not found."), 404
 
     # Create new review record with approval flag set to FALSE
     new_review = Review(
-        user_id=user.id,
-        book_title=title,
+        user_id=current_user_id(),
+        book_id=book.id,
+        book_title=book.title,
         description_text=description,
         is_approved=False
     )
@@ -285,33 +794,31 @@ def submit_review():
 
 @app.route('/reviews/<string:book_title>', methods=['GET'])
 def get_approved_reviews(book_title):
-    # This endpoint fetches reviews that have been approved by an admin
-    approved_reviews = Review.query.filter(
-        Review.book_title == book_title,
+    # This endpoint fetches reviews that have been approved by an admin,
+    # joined with the author's username instead of lazy-loading review.user per row
+    book_ids = db.session.query(Book.id).filter(Book.title == book_title)
+    query = db.session.query(Review.id, Review.description_text, Review.timestamp, User.username).join(User, User.id == Review.user_id).filter(
+        Review.book_id.in_(book_ids),
         Review.is_approved == True
-    ).all()
-    
-    # We must also fetch the username of the person who wrote the review
-    results = []
-    for review in approved_reviews:
-        results.append({
-            'username': review.user.username,
-            'description': review.description_text,
-            'timestamp': review.timestamp.isoformat()
-        })
-        
-    return jsonify(results)
+    ).order_by(Review.id)
+    def serialize(row):
+        return {
+            'username': row.username,
+            'description': row.description_text,
+            'timestamp': row.timestamp.isoformat()
+        }
+    return paginated_json(query, Review.id, serialize)
+
 @app.route('/user-stats', methods=['GET'])
 @jwt_required()
 def get_user_stats():
-    current_user_username = get_jwt_identity()
-    user = User.query.filter_by(username=current_user_username).first()
+    user_id = current_user_id()
 
-    if not user:
+    if user_id is None:
         return jsonify(msg="User not found."), 404
 
     # --- CORRECTED: Query the Rating table for the count ---
-    total_reviews = Rating.query.filter_by(user_id=user.id).count() 
+    total_reviews = Rating.query.filter_by(user_id=user_id).count() 
     
     # We can also simplify the name since it's the count of ratings
     total_ratings_count = total_reviews # Renaming for clarity in the response
@@ -328,8 +835,7 @@ def get_user_stats():
 @app.route('/profile', methods=['GET'])
 @jwt_required()
 def get_profile():
-    current_user_username = get_jwt_identity()
-    user = User.query.filter_by(username=current_user_username).first()
+    user = current_user()
     if not user: 
         return jsonify(msg="User not found"), 404
     # Include 'email' in the response
@@ -344,8 +850,61 @@ def get_profile():
 @app.route('/recommend', methods=['GET'])
 def get_recommendations():
     book_isbn = request.args.get('isbn')
-    if book_isbn: return jsonify(recommend(book_isbn))
-    else: return jsonify({"error": "Book ISBN is required"}), 400
+    if not book_isbn: return jsonify({"error": "Book ISBN is required"}), 400
+    key = response_key(model.version, str(book_isbn).strip())
+    recommendations = response_cache.get('recommend', key)
+    if recommendations is None:
+        recommendations = recommend(book_isbn)
+        response_cache.set('recommend', key, recommendations)
+    with STAGE_SECONDS.time('recommend.serialize'):
+        return jsonify(recommendations)
+
+@app.route('/recommend/for-me', methods=['GET'])
+@jwt_required()
+def get_personal_recommendations():
+    if svd_model is None: return jsonify({"error": "Personalized model is not available"}), 503
+    user_id = current_user_id()
+    if user_id is None: return jsonify(msg="User not found"), 404
+    try: n = max(1, min(int(request.args.get('n', 10)), 50))
+    except ValueError: return jsonify({"error": "Invalid n"}), 400
+    user_ratings = {r.book_title: r.rating for r in Rating.query.filter_by(user_id=user_id)}
+    with STAGE_SECONDS.time('recommend_for_me.score'):
+        scored = svd_model.recommend_for(user_ratings, n)
+    books = {}
+    for b in Book.query.filter(Book.title.in_([title for title, _ in scored])).order_by(Book.id):
+        books.setdefault(b.title, b)
+    return jsonify([dict(book_to_dict(books[title]), predicted_rating=round(score, 2)) for title, score in scored if title in books])
+
+@app.route('/recommend/batch', methods=['POST'])
+def get_batch_recommendations():
+    data = request.get_json(silent=True) or {}
+    book_isbns = data.get('isbns')
+    if not isinstance(book_isbns, list) or not book_isbns: return jsonify({"error": "A non-empty list of ISBNs is required"}), 400
+    if len(book_isbns) > MAX_BATCH_ISBNS: return jsonify({"error": f"At most {MAX_BATCH_ISBNS} ISBNs per request"}), 400
+    return jsonify(recommend_many(book_isbns))
+
+@app.route('/recommend/hybrid', methods=['GET'])
+def get_hybrid_recommendations():
+    # ?isbn= plus the /search filters (genre, price), n and an optional budget_ms
+    book_isbn = request.args.get('isbn')
+    if not book_isbn: return jsonify({"error": "Book ISBN is required"}), 400
+    genre = request.args.get('genre', 'all')
+    try:
+        max_price = float(request.args.get('price', '40'))
+        n = max(1, min(int(request.args.get('n', 5)), 50))
+        budget_ms = float(request.args.get('budget_ms', HYBRID_BUDGET_MS))
+        if math.isnan(max_price) or math.isnan(budget_ms): raise ValueError
+    except ValueError: return jsonify({"error": "price, n and budget_ms must be numbers"}), 400
+    budget_ms = max(MIN_HYBRID_BUDGET_MS, min(budget_ms, MAX_HYBRID_BUDGET_MS))
+    key = response_key(model.version, 'hybrid', str(book_isbn).strip(), genre, max_price, n)
+    books, skipped = response_cache.get('recommend', key), []
+    if books is None:
+        books, skipped = hybrid_recommend(book_isbn, genre, max_price, n, budget_ms)
+        # A ranking cut short by the budget isn't cached, so the next request can do better
+        if not skipped: response_cache.set('recommend', key, books)
+    response = jsonify(books)
+    if skipped: response.headers['X-Ranker-Skipped'] = ','.join(skipped)
+    return response
 
 @app.route('/admin/add-book', methods=['POST'])
 @admin_required()
@@ -356,40 +915,63 @@ def add_book():
     new_book = Book(isbn=data['isbn'], title=data['title'], author=data['author'], year=data.get('year'), publisher=data.get('publisher'), image_url_m=data.get('image_url_m'), genre=data.get('genre'), price=data.get('price'))
     db.session.add(new_book)
     db.session.commit()
+    primary_pins.pin(current_user_id())
+    # The ISBN may be cached as missing, and the new book can change author/genre fallbacks
+    book_cache.delete(new_book.isbn)
+    fallback_cache.clear()
+    response_cache.invalidate('recommend')
+    response_cache.invalidate('search')
+    if local_search_index.loaded:
+        local_search_index.add(new_book.id, new_book.title, new_book.author, new_book.genre, new_book.price)
     return jsonify(msg="Book added successfully"), 201
 
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    return Response(metrics_registry.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/admin/profiler', methods=['POST'])
+@admin_required()
+def toggle_profiler():
+    # {"enabled": true, "threshold_ms": 200} switches the slow-request profiler on this worker
+    data = request.get_json(silent=True) or {}
+    if data.get('enabled'): profiler.enable(data.get('threshold_ms'))
+    else: profiler.disable()
+    return jsonify(enabled=profiler.enabled, threshold_ms=profiler.threshold_ms, out_dir=profiler.out_dir)
+
+@app.route('/admin/cache-stats', methods=['GET'])
+@admin_required()
+def cache_stats():
+    # Hit/miss/eviction counters of this worker's caches (the response cache may be shared)
+    def counters(cache):
+        return {"size": len(cache), "hits": cache.hits, "misses": cache.misses, "evictions": cache.evictions}
+    return jsonify(response_cache=response_cache.stats(), book_cache=counters(book_cache), fallback_cache=counters(fallback_cache))
+
 @app.route('/send-verification-otp', methods=['POST'])
 @jwt_required()
 def send_verification_otp():
-    current_user_username = get_jwt_identity()
-    user = User.query.filter_by(username=current_user_username).first()
+    user = current_user()
     if not user: return jsonify(msg="User not found"), 404
     if user.is_verified: return jsonify(msg="User is already verified"), 400
     otp = str(random.randint(100000, 999999))
-    otp_storage[user.username] = otp
-    sender_email, sender_password = os.getenv("EMAIL_USER"), os.getenv("EMAIL_PASS")
-    message = MIMEMultipart("alternative")
-    message["Subject"], message["From"], message["To"] = "Your Book Recommender Verification Code", sender_email, user.email
+    try: otp_store.issue(f"verify:{user.username}", otp)
+    except TooManyRequests: return jsonify(msg="Too many codes requested. Please try again later."), 429
     html = f"<html><body><p>Your verification code is: <b>{otp}</b></p></body></html>"
-    message.attach(MIMEText(html, "html"))
     try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, user.email, message.as_string())
-        return jsonify(msg="OTP sent successfully"), 200
-    except Exception as e:
-        return jsonify(msg=f"Failed to send OTP: {e}"), 500
+        mail_queue.send(user.email, "Your Book Recommender Verification Code", html)
+    except QueueFull:
+        return jsonify(msg="Too many e-mails are waiting to be sent. Please try again shortly."), 503
+    return jsonify(msg="OTP sent successfully"), 202
 
 @app.route('/verify-otp', methods=['POST'])
 @jwt_required()
 def verify_otp():
-    current_user_username = get_jwt_identity()
-    user = User.query.filter_by(username=current_user_username).first()
+    user = current_user()
     otp_from_user = request.get_json().get('otp')
-    if user.username in otp_storage and otp_storage[user.username] == otp_from_user:
+    try: valid = otp_store.verify(f"verify:{user.username}", otp_from_user)
+    except TooManyAttempts: return jsonify(msg="Too many incorrect attempts. Please request a new code."), 429
+    if valid:
         user.is_verified = True
         db.session.commit()
-        del otp_storage[user.username]
         return jsonify(msg="Email verified successfully!"), 200
     return jsonify(msg="Invalid or expired OTP"), 400
 
@@ -400,31 +982,22 @@ def forgot_password():
 
     if not user:
         # Still send a success message to not reveal which emails are registered
-        return jsonify(msg="If this email is registered, a recovery OTP has been sent."), 200
+        return jsonify(msg="If this email is registered, a recovery OTP has been sent."), 202
 
     otp = str(random.randint(100000, 999999))
-    # Store OTP with a key that includes email to distinguish from verification OTPs
-    otp_storage[f"reset_{user.username}"] = otp
+    # Separate key so a reset code can't be used for verification and vice versa
+    try: otp_store.issue(f"reset:{user.username}", otp)
+    except TooManyRequests:
+        # Same answer as for unknown addresses, so the limit doesn't reveal registered emails
+        return jsonify(msg="If this email is registered, a recovery OTP has been sent."), 202
 
-    # --- Email Sending Logic ---
-    sender_email = os.getenv("EMAIL_USER")
-    sender_password = os.getenv("EMAIL_PASS")
-    
-    message = MIMEMultipart("alternative")
-    message["Subject"] = "Your Password Reset Code"
-    message["From"] = sender_email
-    message["To"] = user.email
+    # --- Email Sending Logic (delivered in the background) ---
     html = f"<html><body><p>Your password reset code is: <b>{otp}</b></p></body></html>"
-    message.attach(MIMEText(html, "html"))
-
     try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(sender_email, sender_password)
-            server.sendmail(sender_email, user.email, message.as_string())
-        return jsonify(msg="If this email is registered, a recovery OTP has been sent."), 200
-    except Exception as e:
-        print(f"Email sending failed: {e}")
-        return jsonify(msg="Failed to send OTP."), 500
+        mail_queue.send(user.email, "Your Password Reset Code", html)
+    except QueueFull:
+        return jsonify(msg="Failed to send OTP."), 503
+    return jsonify(msg="If this email is registered, a recovery OTP has been sent."), 202
 
 
 @app.route('/reset-password', methods=['POST'])
@@ -446,18 +1019,18 @@ def reset_password():
     if check_password_hash(user.password_hash, new_password):
         return jsonify(msg="The new password cannot be the same as your current password."), 400
     # Check if the OTP is correct
-    if f"reset_{user.username}" in otp_storage and otp_storage[f"reset_{user.username}"] == otp:
+    try: valid = otp_store.verify(f"reset:{user.username}", otp)
+    except TooManyAttempts: return jsonify(msg="Too many incorrect attempts. Please request a new code."), 429
+    if valid:
         user.password_hash = generate_password_hash(new_password)
         db.session.commit()
-        del otp_storage[f"reset_{user.username}"] # Clean up OTP
         return jsonify(msg="Password updated successfully. Please log in."), 200
     
     return jsonify(msg="Invalid or expired OTP."), 400
 @app.route('/update-password', methods=['POST'])
 @jwt_required()
 def update_password():
-    current_user_username = get_jwt_identity()
-    user = User.query.filter_by(username=current_user_username).first()
+    user = current_user()
     data = request.get_json()
     new_password = data.get('new_password')
     
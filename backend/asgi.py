@@ -0,0 +1,152 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+from a2wsgi import WSGIMiddleware
+from flask import g
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+
+import app as api
+from cache import response_key
+from db_routing import REPLICA_BIND
+
+# ASGI serving mode (pip install -r requirements-asgi.txt):
+#
+#   uvicorn asgi:application --host 0.0.0.0 --port 5000 --workers 4
+#   gunicorn -k uvicorn.workers.UvicornWorker -w 4 -b 0.0.0.0:5000 asgi:application
+#
+# Connections live on the event loop, so slow clients and idle keep-alives don't hold a thread.
+# GET /recommend is served natively: model lookups run on a small scoring pool (NumPy releases
+# the GIL) and book rows are read through an async engine with its own connection pool. Every
+# other route runs the Flask app on a pool of WSGI_THREADS threads, like gunicorn's gthread worker.
+# Both pools use the Flask engine's connections, so keep WSGI_THREADS + SCORING_WORKERS within
+# DB_POOL_SIZE + DB_MAX_OVERFLOW (5 + 10 by default): threads beyond that starve waiting for a connection.
+# /recommend only reads the catalog, so with DATABASE_REPLICA_URL set it reads from the replica.
+SCORING_WORKERS = int(os.getenv('SCORING_WORKERS', '4'))
+WSGI_THREADS = int(os.getenv('WSGI_THREADS', '10'))
+ASYNC_DB_POOL_SIZE = int(os.getenv('ASYNC_DB_POOL_SIZE', '10'))
+ASYNC_DB_MAX_OVERFLOW = int(os.getenv('ASYNC_DB_MAX_OVERFLOW', '20'))
+ASYNC_DRIVERS = {'postgresql': 'postgresql+asyncpg', 'sqlite': 'sqlite+aiosqlite'}
+BOOK_COLUMNS = (api.Book.isbn, api.Book.title, api.Book.author, api.Book.image_url_m, api.Book.genre, api.Book.price)
+
+
+def async_database_url(engine):
+    # The engine's URL with the async driver: postgresql+asyncpg or sqlite+aiosqlite; None for other
+    # backends. Taken from the engine rather than the env var, so relative SQLite paths are the ones
+    # Flask-SQLAlchemy resolved (under the instance folder).
+    driver = ASYNC_DRIVERS.get(engine.url.get_backend_name())
+    return engine.url.set(drivername=driver) if driver else None
+
+
+def catalog_engine(flask_app):
+    # The replica when DATABASE_REPLICA_URL is set, else the primary
+    with flask_app.app_context():
+        return api.db.engines.get(REPLICA_BIND) or api.db.engine
+
+
+def make_async_engine(url):
+    # None without a usable async driver; /recommend then reads book rows on a worker thread
+    if url is None:
+        return None
+    url = make_url(url)
+    options = {} if url.get_backend_name() == 'sqlite' else {
+        'pool_size': ASYNC_DB_POOL_SIZE, 'max_overflow': ASYNC_DB_MAX_OVERFLOW, 'pool_pre_ping': True}
+    try:
+        from sqlalchemy.ext.asyncio import create_async_engine  # needs greenlet
+
+        return create_async_engine(url, **options)
+    except ImportError as e:
+        print(f"Async database driver not available ({e}); /recommend will use the Flask session.")
+        return None
+
+
+async def send_json(send, status, body):
+    payload = api.app.json.dumps(body).encode()
+    # Same CORS header flask_cors adds to the Flask routes
+    await send({'type': 'http.response.start', 'status': status, 'headers': [
+        (b'content-type', b'application/json'), (b'content-length', str(len(payload)).encode()),
+        (b'access-control-allow-origin', b'*')]})
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+class Application:
+    def __init__(self, flask_app, database_url=None):
+        self.wsgi = WSGIMiddleware(flask_app, workers=WSGI_THREADS)
+        self.scoring = ThreadPoolExecutor(max_workers=SCORING_WORKERS, thread_name_prefix='scoring')
+        self.engine = make_async_engine(database_url)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+        if scope['type'] == 'http' and scope['method'] == 'GET' and scope['path'] == '/recommend':
+            return await self.recommend(scope, send)
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.engine is not None:
+                    await self.engine.dispose()
+                self.scoring.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def recommend(self, scope, send):
+        # Same contract as app.get_recommendations()
+        started = time.perf_counter()
+        isbn = parse_qs(scope['query_string'].decode('latin-1')).get('isbn', [''])[0].strip()
+        if isbn:
+            status, body = 200, await self.recommendations(isbn)
+        else:
+            status, body = 400, {"error": "Book ISBN is required"}
+        await send_json(send, status, body)
+        api.REQUEST_SECONDS.observe(time.perf_counter() - started, '/recommend', 'GET', str(status))
+
+    async def recommendations(self, isbn):
+        loop = asyncio.get_running_loop()
+        key, books, isbns = await loop.run_in_executor(self.scoring, self.lookup, isbn)
+        if books is not None:
+            return books
+        if isbns is None or self.engine is None:
+            # Books added after the model was built (author/genre queries), or no async driver
+            books = await loop.run_in_executor(self.scoring, self.recommend_sync, isbn)
+        else:
+            books = await self.hydrate(isbns)
+        await loop.run_in_executor(self.scoring, api.response_cache.set, 'recommend', key, books)
+        return books
+
+    @staticmethod
+    def lookup(isbn):
+        # On the scoring pool: hot model reload check, cached response, then the model lookup
+        api.reload_model_if_published()
+        key = response_key(api.model.version, isbn)
+        books = api.response_cache.get('recommend', key)
+        return key, books, api.recommended_isbns(isbn) if books is None else None
+
+    @staticmethod
+    def recommend_sync(isbn):
+        with api.app.app_context():
+            g.use_replica = True
+            return api.recommend(isbn)
+
+    async def hydrate(self, isbns):
+        # app.hydrate_books() with the missing rows read through the async engine
+        cached = api.book_cache.get_many(isbns)
+        missing = list(dict.fromkeys(i for i in isbns if i not in cached))
+        if missing:
+            async with self.engine.connect() as conn:
+                rows = await conn.execute(select(*BOOK_COLUMNS).where(api.Book.isbn.in_(missing)))
+            found = {row.isbn: api.book_to_dict(row) for row in rows}
+            for isbn in missing:
+                cached[isbn] = found.get(isbn)
+                api.book_cache.set(isbn, cached[isbn])
+        return [cached[i] for i in isbns if cached.get(i)]
+
+
+application = Application(api.app, os.getenv('ASYNC_DATABASE_URL') or async_database_url(catalog_engine(api.app)))
@@ -0,0 +1,257 @@
+import argparse
+import json
+import os
+import random
+import resource
+import string
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Reproducible performance numbers for the model build and the API hot paths.
+# Generates a synthetic Book-Crossing-shaped dataset, times the model_builder.py
+# stages, then drives the Flask app through its test client against a local
+# database (SQLite by default, or --database-url for a Postgres stand-in):
+#
+#   python benchmark.py --books 100000 --requests 2000 --out bench.json
+#
+# --asgi repeats the endpoint workloads through asgi.application on one event loop.
+
+GENRES = ['Fiction', 'Mystery', 'Science Fiction', 'Fantasy', 'Thriller', 'Romance', 'Non-Fiction', 'Biography']
+WORDS = ['night', 'house', 'river', 'stone', 'secret', 'garden', 'winter', 'shadow', 'king', 'road', 'island', 'letter']
+
+
+def peak_rss_mb():
+    # ru_maxrss is KB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def generate_dataset(workdir, n_books, n_users, n_ratings, seed):
+    rng = np.random.default_rng(seed)
+    isbns = np.char.zfill(np.arange(n_books).astype(str), 10)
+    titles = [f"{WORDS[a].title()} of the {WORDS[b]} {i}" for i, (a, b) in enumerate(rng.integers(0, len(WORDS), (n_books, 2)))]
+    books = pd.DataFrame({
+        'ISBN': isbns, 'Book-Title': titles,
+        'Book-Author': [f"Author {a}" for a in rng.integers(0, max(n_books // 20, 1), n_books)],
+        'Year-Of-Publication': rng.integers(1950, 2024, n_books), 'Publisher': 'Synthetic Press',
+        'Image-URL-M': [f"http://images.example.com/{i}.jpg" for i in isbns],
+    })
+    books.to_csv(os.path.join(workdir, 'Books.csv'), index=False)
+    books['Genre'] = rng.choice(GENRES, n_books)
+    books['Price'] = np.round(rng.uniform(5.0, 40.0, n_books), 2)
+    books.to_csv(os.path.join(workdir, 'books_enriched.csv'), index=False)
+    # Zipf-ish popularity so a realistic head of books and users passes the rating filters
+    book_idx = np.minimum(rng.zipf(1.3, n_ratings) - 1, n_books - 1)
+    user_idx = np.minimum(rng.zipf(1.3, n_ratings) - 1, n_users - 1)
+    ratings = pd.DataFrame({'User-ID': user_idx + 1, 'ISBN': isbns[book_idx], 'Book-Rating': rng.integers(0, 11, n_ratings)})
+    ratings.to_csv(os.path.join(workdir, 'Ratings.csv'), index=False)
+    return books
+
+
+def timed(stages, name, fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    stages[name] = {"seconds": round(time.perf_counter() - start, 3), "peak_rss_mb": peak_rss_mb()}
+    return result
+
+
+def benchmark_build(args):
+    import model_builder
+    import preprocess
+    from model_store import new_version_dir, publish_version, save_artifacts, MODEL_DIR
+
+    stages = {}
+    # Always measures the streaming passes, not a reused intermediate from an earlier run
+    timed(stages, 'preprocess', preprocess.prepare, args.min_book_ratings, args.min_user_ratings)
+    final_df = timed(stages, 'load_prepared', preprocess.load_prepared, args.min_book_ratings, args.min_user_ratings)
+    out_dir = new_version_dir(MODEL_DIR)
+    isbns, pivot, user_ids, neighbor_ids, neighbor_scores = timed(stages, 'similarity', model_builder.build_sparse, final_df, out_dir)
+    timed(stages, 'save_artifacts', save_artifacts, out_dir, isbns, neighbor_ids, neighbor_scores, pivot=pivot, user_ids=user_ids)
+    publish_version(MODEL_DIR, out_dir)
+    return {"stages": stages, "rated_books": int(len(isbns)), "pivot_users": int(len(user_ids)), "ratings_after_filter": int(len(final_df))}
+
+
+def seed_app(app_module, books, n_app_users, ratings_per_user, seed):
+    from flask_jwt_extended import create_access_token
+
+    rng = random.Random(seed)
+    app, db = app_module.app, app_module.db
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        rows = books.rename(columns={'ISBN': 'isbn', 'Book-Title': 'title', 'Book-Author': 'author', 'Year-Of-Publication': 'year',
+                                     'Publisher': 'publisher', 'Image-URL-M': 'image_url_m', 'Genre': 'genre', 'Price': 'price'})
+        rows['year'] = rows['year'].astype(str)
+        db.session.bulk_insert_mappings(app_module.Book, rows.to_dict(orient='records'))
+        users = [app_module.User(username=f"bench{i}", email=f"bench{i}@example.com", password_hash='x', is_verified=True) for i in range(n_app_users)]
+        db.session.add_all(users)
+        db.session.flush()
+        book_ids = db.session.query(app_module.Book.id, app_module.Book.title).all()
+        db.session.bulk_insert_mappings(app_module.Rating, [
+            {"user_id": u.id, "book_id": book_id, "book_title": title, "rating": rng.randint(1, 5)}
+            for u in users for book_id, title in rng.sample(book_ids, min(ratings_per_user, len(book_ids)))])
+        db.session.commit()
+        app_module.rebuild_rating_stats()
+        return [create_access_token(identity=u.username, additional_claims=app_module.identity_claims(u)) for u in users]
+
+
+def summarize(latencies, wall_seconds, errors):
+    latencies = np.asarray(latencies) * 1000
+    return {
+        "requests": int(len(latencies)), "errors": errors,
+        "p50_ms": round(float(np.percentile(latencies, 50)), 3), "p95_ms": round(float(np.percentile(latencies, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies, 99)), 3), "mean_ms": round(float(latencies.mean()), 3),
+        "throughput_rps": round(len(latencies) / wall_seconds, 1), "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def drive(app, make_request, n_requests, concurrency):
+    # make_request(i) -> (method, url, kwargs). One test client per thread.
+    local = threading.local()
+    lock = threading.Lock()
+    errors = [0]
+
+    def one(i):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+        method, url, kwargs = make_request(i)
+        start = time.perf_counter()
+        response = getattr(local.client, method)(url, **kwargs)
+        # Streamed bodies (paginated_json) only run their query and serialization when read
+        response.get_data()
+        response.close()
+        elapsed = time.perf_counter() - start
+        if response.status_code >= 400:
+            with lock:
+                errors[0] += 1
+        return elapsed
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = list(pool.map(one, range(n_requests)))
+    return summarize(latencies, time.perf_counter() - start, errors[0])
+
+
+def drive_asgi(application, make_request, n_requests, concurrency):
+    # Same as drive(), with `concurrency` requests in flight on one event loop
+    import asyncio
+    import httpx
+
+    async def run():
+        latencies, errors, pending = [], [0], iter(range(n_requests))
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=application), base_url='http://bench') as client:
+            async def worker():
+                for i in pending:
+                    method, url, kwargs = make_request(i)
+                    start = time.perf_counter()
+                    response = await client.request(method.upper(), url, **kwargs)
+                    latencies.append(time.perf_counter() - start)
+                    errors[0] += response.status_code >= 400
+            start = time.perf_counter()
+            await asyncio.gather(*(worker() for _ in range(concurrency)))
+        return summarize(latencies, time.perf_counter() - start, errors[0])
+
+    return asyncio.run(run())
+
+
+def benchmark_endpoints(args, books, rated_isbns):
+    import app as app_module
+
+    tokens = seed_app(app_module, books, args.app_users, args.ratings_per_user, args.seed)
+    rng = random.Random(args.seed)
+    all_isbns = books['ISBN'].tolist()
+    model_isbns = list(rated_isbns) or all_isbns
+    terms = WORDS + [''.join(rng.choices(string.ascii_lowercase, k=3)) for _ in range(10)]
+
+    def recommend(i):
+        # Mostly books in the model, some cold-start books that take the content fallback
+        isbn = rng.choice(model_isbns) if rng.random() < 0.8 else rng.choice(all_isbns)
+        return 'get', f'/recommend?isbn={isbn}', {}
+
+    def search(i):
+        headers = {'Authorization': f'Bearer {rng.choice(tokens)}'} if rng.random() < 0.5 else {}
+        return 'get', f'/search?q={rng.choice(terms)}&genre={rng.choice(GENRES + ["all"])}&price=40', {'headers': headers}
+
+    def my_ratings(i):
+        return 'get', '/my-ratings', {'headers': {'Authorization': f'Bearer {rng.choice(tokens)}'}}
+
+    def mixed(i):
+        return (recommend, search, my_ratings)[i % 3](i)
+
+    def cold(driver, target, fn):
+        # Every workload starts with empty caches, so the modes are compared on equal terms
+        for cache in (app_module.book_cache, app_module.fallback_cache, app_module.rating_map_cache, app_module.identity_cache):
+            cache.clear()
+        app_module.response_cache.invalidate('recommend')
+        app_module.response_cache.invalidate('search')
+        return driver(target, fn, args.requests, args.concurrency)
+
+    workloads = [('/recommend', recommend), ('/search', search), ('/my-ratings', my_ratings), ('mixed', mixed)]
+    # One untimed request each, so one-off startup work (e.g. loading the search index) isn't measured
+    client = app_module.app.test_client()
+    for _, fn in workloads:
+        method, url, kwargs = fn(0)
+        getattr(client, method)(url, **kwargs).get_data()
+    results = {name: cold(drive, app_module.app, fn) for name, fn in workloads}
+    if args.asgi:
+        import asgi
+        results['asgi'] = {name: cold(drive_asgi, asgi.application, fn) for name, fn in workloads}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the model build and the recommendation/search endpoints.")
+    parser.add_argument('--books', type=int, default=10000)
+    parser.add_argument('--users', type=int, default=5000, help="Book-Crossing users in the synthetic ratings")
+    parser.add_argument('--ratings', type=int, default=None, help="synthetic ratings (default: 20 per book)")
+    parser.add_argument('--min-book-ratings', type=int, default=50)
+    parser.add_argument('--min-user-ratings', type=int, default=200)
+    parser.add_argument('--app-users', type=int, default=50)
+    parser.add_argument('--ratings-per-user', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=500)
+    parser.add_argument('--concurrency', type=int, default=1)
+    parser.add_argument('--asgi', action='store_true', help="also drive the endpoints through asgi.py (pip install -r requirements-asgi.txt)")
+    parser.add_argument('--database-url', default=None, help="defaults to a SQLite file in the work directory")
+    parser.add_argument('--workdir', default=None)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--out', default=None, help="write the JSON report here as well as to stdout")
+    args = parser.parse_args()
+
+    out_path = os.path.abspath(args.out) if args.out else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench-')
+    os.makedirs(workdir, exist_ok=True)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(workdir)
+    # app.py reads its configuration at import time
+    os.environ['MODEL_DIR'] = os.path.join(workdir, 'model')
+    os.environ.setdefault('DATABASE_URL', args.database_url or f"sqlite:///{os.path.join(workdir, 'bench.db')}")
+    os.environ.setdefault('JWT_SECRET_KEY', 'benchmark-secret-key-with-enough-bytes')
+    os.environ.setdefault('SUPABASE_URL', 'https://benchmark.supabase.co')
+    os.environ.setdefault('SUPABASE_KEY', 'benchmark')
+
+    report = {"params": vars(args) | {"workdir": workdir}}
+    start = time.perf_counter()
+    books = generate_dataset(workdir, args.books, args.users, args.ratings or args.books * 20, args.seed)
+    report["generate_seconds"] = round(time.perf_counter() - start, 3)
+    report["build"] = benchmark_build(args)
+
+    from model_store import ModelArtifacts
+    rated_isbns = [str(i) for i in ModelArtifacts(os.environ['MODEL_DIR']).isbns]
+    report["endpoints"] = benchmark_endpoints(args, books, rated_isbns)
+    report["peak_rss_mb"] = peak_rss_mb()
+
+    output = json.dumps(report, indent=2)
+    print(output)
+    if out_path:
+        with open(out_path, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    # Thread-safe in-process LRU cache whose entries also expire after `ttl` seconds.
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _get(self, key, now):
+        entry = self._data.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if expires_at < now:
+            del self._data[key]
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._get(key, time.monotonic())
+            if found:
+                self.hits += 1
+                return value
+            self.misses += 1
+            return default
+
+    def get_many(self, keys):
+        # Returns {key: value} for the keys that are cached; missing keys are left out.
+        now = time.monotonic()
+        result = {}
+        with self._lock:
+            for key in keys:
+                found, value = self._get(key, now)
+                if found:
+                    self.hits += 1
+                    result[key] = value
+                else:
+                    self.misses += 1
+        return result
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def response_key(*parts):
+    # Stable digest of the parts that determine a response (query parameters, model version)
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class LocalResponseCache:
+    # Response cache for a single process. Each namespace has a generation that is part of
+    # every key, so invalidate() is O(1); superseded entries age out through the LRU.
+    def __init__(self, maxsize=10000, ttl=60):
+        self._cache = TTLCache(maxsize, ttl)
+        self._generations = {}
+
+    def get(self, namespace, key):
+        return self._cache.get((namespace, self._generations.get(namespace, 0), key))
+
+    def set(self, namespace, key, value):
+        self._cache.set((namespace, self._generations.get(namespace, 0), key), value)
+
+    def invalidate(self, namespace):
+        self._generations[namespace] = self._generations.get(namespace, 0) + 1
+
+    def stats(self):
+        return {"backend": "local", "size": len(self._cache), "hits": self._cache.hits,
+                "misses": self._cache.misses, "evictions": self._cache.evictions}
+
+
+class RedisResponseCache:
+    # Response cache shared by every worker and node through any server speaking the Redis
+    # protocol. Values are JSON; the namespace generation lives in the server, so an
+    # invalidation on one worker is seen by all of them. Server errors count as misses.
+    def __init__(self, url, ttl=60, prefix='response-cache'):
+        import redis  # optional dependency, only needed when RESPONSE_CACHE_URL is set
+
+        self._redis = redis.Redis.from_url(url)
+        self._errors = redis.RedisError
+        self.ttl = ttl
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _count(self, hit):
+        with self._lock:
+            if hit: self.hits += 1
+            else: self.misses += 1
+
+    def _key(self, namespace, key):
+        generation = self._redis.get(f"{self.prefix}:{namespace}:generation") or b'0'
+        return f"{self.prefix}:{namespace}:{generation.decode()}:{key}"
+
+    def get(self, namespace, key):
+        try:
+            raw = self._redis.get(self._key(namespace, key))
+        except self._errors:
+            raw = None
+        self._count(raw is not None)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, namespace, key, value):
+        try:
+            self._redis.set(self._key(namespace, key), json.dumps(value), ex=self.ttl)
+        except self._errors:
+            pass
+
+    def invalidate(self, namespace):
+        try:
+            self._redis.incr(f"{self.prefix}:{namespace}:generation")
+        except self._errors:
+            pass
+
+    def stats(self):
+        try:
+            evictions = self._redis.info('stats').get('evicted_keys', 0)
+        except self._errors:
+            evictions = None
+        return {"backend": "redis", "hits": self.hits, "misses": self.misses, "evictions": evictions}
+
+
+def make_response_cache(url=None, maxsize=10000, ttl=60):
+    # redis://host:port/db selects the shared backend, anything else the in-process one
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisResponseCache(url, ttl=ttl)
+    return LocalResponseCache(maxsize=maxsize, ttl=ttl)
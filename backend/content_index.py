@@ -0,0 +1,132 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from model_store import IsbnMap, artifact_path
+from neighbor_index import top_k_neighbors
+
+# Content-based fallback for books outside the rating pivot, built by model_builder.py
+# from the catalog CSV and stored next to the item-item artifacts. Author and genre are
+# CSR-style posting lists (rows grouped by key, catalog order within a key), so /recommend
+# resolves a cold-start book with array slices instead of database queries.
+CONTENT_ISBNS_FILE = 'content_isbns.npy'                  # row -> ISBN, catalog order
+CONTENT_ISBN_KEYS_FILE = 'content_isbn_keys.npy'          # sorted ISBNs  } ISBN -> row,
+CONTENT_ISBN_ROWS_FILE = 'content_isbn_rows.npy'          # row of each key } like IsbnMap
+CONTENT_TITLE_CODES_FILE = 'content_title_codes.npy'      # row -> title code, to skip other editions
+CONTENT_AUTHOR_CODES_FILE = 'content_author_codes.npy'    # row -> author code
+CONTENT_AUTHOR_OFFSETS_FILE = 'content_author_offsets.npy'
+CONTENT_AUTHOR_ROWS_FILE = 'content_author_rows.npy'
+CONTENT_GENRE_CODES_FILE = 'content_genre_codes.npy'      # row -> genre code, -1 without a genre
+CONTENT_GENRE_OFFSETS_FILE = 'content_genre_offsets.npy'
+CONTENT_GENRE_ROWS_FILE = 'content_genre_rows.npy'
+CONTENT_TFIDF_FILE = 'content_tfidf.npz'                  # optional L2-normalized TF-IDF of title + publisher
+CONTENT_FILES = [
+    CONTENT_ISBNS_FILE, CONTENT_ISBN_KEYS_FILE, CONTENT_ISBN_ROWS_FILE, CONTENT_TITLE_CODES_FILE,
+    CONTENT_AUTHOR_CODES_FILE, CONTENT_AUTHOR_OFFSETS_FILE, CONTENT_AUTHOR_ROWS_FILE,
+    CONTENT_GENRE_CODES_FILE, CONTENT_GENRE_OFFSETS_FILE, CONTENT_GENRE_ROWS_FILE, CONTENT_TFIDF_FILE,
+]
+
+CATALOG_CSV = 'books_enriched.csv'
+CATALOG_COLUMNS = ['ISBN', 'Book-Title', 'Book-Author', 'Publisher', 'Genre']
+TFIDF_MAX_FEATURES = 50000
+
+
+def build_postings(codes, n_keys):
+    # offsets[k]:offsets[k + 1] slices the rows of key k out of `rows`; code -1 has no postings
+    valid = np.flatnonzero(codes >= 0)
+    rows = valid[np.argsort(codes[valid], kind='stable')]
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(codes[valid], minlength=n_keys))])
+    return offsets.astype(np.int64), rows.astype(np.int32)
+
+
+def read_catalog(catalog_csv=CATALOG_CSV):
+    # Same cleanup as seed_database.py, so the rows match the book table
+    books = pd.read_csv(catalog_csv, usecols=CATALOG_COLUMNS, dtype=str)
+    books['ISBN'] = books['ISBN'].str.strip()
+    books = books.drop_duplicates(subset='ISBN', keep='last').dropna(subset=['Book-Title'])
+    books['Book-Author'] = books['Book-Author'].fillna('Unknown')
+    books['Publisher'] = books['Publisher'].fillna('Unknown')
+    return books.reset_index(drop=True)
+
+
+def build_content_index(out_dir, catalog_csv=CATALOG_CSV, tfidf=False):
+    books = read_catalog(catalog_csv)
+    isbns = books['ISBN'].to_numpy(dtype=str)
+    order = np.argsort(isbns, kind='stable')
+    title_codes, _ = pd.factorize(books['Book-Title'])
+    author_codes, authors = pd.factorize(books['Book-Author'])
+    genre_codes, genres = pd.factorize(books['Genre'])
+    author_offsets, author_rows = build_postings(author_codes, len(authors))
+    genre_offsets, genre_rows = build_postings(genre_codes, len(genres))
+
+    arrays = {
+        CONTENT_ISBNS_FILE: isbns, CONTENT_ISBN_KEYS_FILE: isbns[order], CONTENT_ISBN_ROWS_FILE: order.astype(np.int32),
+        CONTENT_TITLE_CODES_FILE: title_codes.astype(np.int32),
+        CONTENT_AUTHOR_CODES_FILE: author_codes.astype(np.int32),
+        CONTENT_AUTHOR_OFFSETS_FILE: author_offsets, CONTENT_AUTHOR_ROWS_FILE: author_rows,
+        CONTENT_GENRE_CODES_FILE: genre_codes.astype(np.int32),
+        CONTENT_GENRE_OFFSETS_FILE: genre_offsets, CONTENT_GENRE_ROWS_FILE: genre_rows,
+    }
+    for name, array in arrays.items():
+        np.save(artifact_path(out_dir, name), array)
+    if tfidf:
+        from sklearn.feature_extraction.text import TfidfVectorizer
+
+        text = books['Book-Title'] + ' ' + books['Publisher']
+        vectors = TfidfVectorizer(max_features=TFIDF_MAX_FEATURES, min_df=2, dtype=np.float32).fit_transform(text)
+        sparse.save_npz(artifact_path(out_dir, CONTENT_TFIDF_FILE), vectors.tocsr())
+    return len(isbns)
+
+
+class ContentIndex:
+    def __init__(self, model_dir):
+        load = lambda name: np.load(artifact_path(model_dir, name), mmap_mode='r')
+        self.isbns = load(CONTENT_ISBNS_FILE)
+        self.isbn_map = IsbnMap(load(CONTENT_ISBN_KEYS_FILE), load(CONTENT_ISBN_ROWS_FILE))
+        self.title_codes = load(CONTENT_TITLE_CODES_FILE)
+        self.author_codes = load(CONTENT_AUTHOR_CODES_FILE)
+        self.author_offsets = load(CONTENT_AUTHOR_OFFSETS_FILE)
+        self.author_rows = load(CONTENT_AUTHOR_ROWS_FILE)
+        self.genre_codes = load(CONTENT_GENRE_CODES_FILE)
+        self.genre_offsets = load(CONTENT_GENRE_OFFSETS_FILE)
+        self.genre_rows = load(CONTENT_GENRE_ROWS_FILE)
+        tfidf_path = artifact_path(model_dir, CONTENT_TFIDF_FILE)
+        self.tfidf = sparse.load_npz(tfidf_path).tocsr() if os.path.exists(tfidf_path) else None
+
+    @classmethod
+    def load(cls, model_dir):
+        # None when the model was built without a catalog CSV next to it.
+        if not os.path.exists(artifact_path(model_dir, CONTENT_ISBNS_FILE)):
+            return None
+        return cls(model_dir)
+
+    def __contains__(self, isbn):
+        return isbn in self.isbn_map
+
+    @staticmethod
+    def _posting(offsets, rows, code):
+        if code < 0:
+            return np.empty(0, dtype=np.int32)
+        return np.asarray(rows[offsets[code]:offsets[code + 1]])
+
+    def _best(self, row, candidates, n):
+        # Catalog order, or the closest titles/publishers first when TF-IDF was built
+        candidates = candidates[candidates != row]
+        if self.tfidf is None or len(candidates) == 0:
+            return candidates[:n]
+        scores = (self.tfidf[candidates] @ self.tfidf[row].T).toarray().ravel()
+        ids, _ = top_k_neighbors(scores[np.newaxis, :], n)
+        return candidates[ids[0]]
+
+    def similar(self, isbn, n=5):
+        # Same author first, then the same genre minus titles already picked. Raises KeyError
+        # for ISBNs that were not in the catalog when the model was built.
+        row = self.isbn_map.row(isbn)
+        picked = self._best(row, self._posting(self.author_offsets, self.author_rows, self.author_codes[row]), n)
+        if len(picked) < n:
+            genre = self._posting(self.genre_offsets, self.genre_rows, self.genre_codes[row])
+            genre = genre[~np.isin(self.title_codes[genre], self.title_codes[np.append(picked, row)])]
+            picked = np.concatenate([picked, self._best(row, genre, n - len(picked))])
+        return [str(self.isbns[r]) for r in picked]
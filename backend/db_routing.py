@@ -0,0 +1,92 @@
+import os
+
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+
+from cache import TTLCache
+
+# Connection pools and read replica routing for the Flask-SQLAlchemy engines.
+#
+# DATABASE_REPLICA_URL adds a 'replica' bind. Requests that set g.use_replica (app.py does it
+# for the read-only endpoints) run their SELECTs there; flushes, DML and every other request
+# use the primary. A replica lags the primary, so after a write app.py pins the writer to the
+# primary for REPLICA_PIN_SECONDS: they read their own ratings back, everyone else may briefly
+# see the previous ones. Pins are kept per process, or in Redis when REPLICA_PIN_URL (default
+# RESPONSE_CACHE_URL) is a redis:// URL, so a user's next request can land on any worker.
+REPLICA_BIND = 'replica'
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))        # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))        # reconnect before server/proxy idle timeouts
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', '1') == '1'
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '0'))  # PostgreSQL only, 0 = none
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', '10'))   # should exceed the worst replication lag
+
+
+def engine_options(url):
+    # create_engine() keyword arguments for SQLALCHEMY_ENGINE_OPTIONS and the replica bind.
+    # SQLite keeps Flask-SQLAlchemy's defaults (in-memory databases need a StaticPool).
+    if not url or url.startswith('sqlite'):
+        return {}
+    options = {'pool_size': DB_POOL_SIZE, 'max_overflow': DB_MAX_OVERFLOW, 'pool_timeout': DB_POOL_TIMEOUT,
+               'pool_recycle': DB_POOL_RECYCLE, 'pool_pre_ping': DB_POOL_PRE_PING}
+    if DB_STATEMENT_TIMEOUT_MS and url.startswith('postgres'):
+        options['connect_args'] = {'options': f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'}
+    return options
+
+
+def replica_binds(url):
+    # SQLALCHEMY_BINDS entry for the replica, with the same pool settings as the primary
+    if not url:
+        return {}
+    return {REPLICA_BIND: dict(engine_options(url), url=url)}
+
+
+class RoutingSession(Session):
+    # db.session class (SQLAlchemy(app, session_options={'class_': RoutingSession}))
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and not getattr(clause, 'is_dml', False) \
+                and has_app_context() and g.get('use_replica'):
+            engine = self._db.engines.get(REPLICA_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+class LocalPrimaryPins:
+    def __init__(self, ttl=REPLICA_PIN_SECONDS, maxsize=100000):
+        self._pins = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def pin(self, user_id):
+        self._pins.set(user_id, True)
+
+    def is_pinned(self, user_id):
+        return self._pins.get(user_id) is not None
+
+
+class RedisPrimaryPins:
+    def __init__(self, url, ttl=REPLICA_PIN_SECONDS, prefix='primary-pin'):
+        import redis  # optional dependency, only needed when REPLICA_PIN_URL is a redis:// URL
+
+        self._redis = redis.Redis.from_url(url)
+        self._errors = redis.RedisError
+        self.ttl, self.prefix = ttl, prefix
+
+    def pin(self, user_id):
+        try:
+            self._redis.set(f"{self.prefix}:{user_id}", 1, ex=self.ttl)
+        except self._errors as e:
+            print(f"Could not pin user {user_id} to the primary: {e}")
+
+    def is_pinned(self, user_id):
+        # Unreachable Redis reads from the primary: slower, never stale
+        try:
+            return bool(self._redis.exists(f"{self.prefix}:{user_id}"))
+        except self._errors:
+            return True
+
+
+def make_primary_pins(url=None):
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisPrimaryPins(url)
+    return LocalPrimaryPins()
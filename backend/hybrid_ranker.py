@@ -0,0 +1,93 @@
+import time
+
+import numpy as np
+
+from neighbor_index import top_k_neighbors
+
+# Ranking stage for /recommend/hybrid. Candidates gathered from the item-item neighbors (or
+# the ANN index), the SVD item factors, the content postings and the most rated books are
+# scored on every signal at once: one (signals x candidates) matrix, each row min-max scaled
+# over the candidates so cosines, factor similarities and rating counts are comparable, then
+# a single weighted sum. Signals with no opinion on a candidate (NaN) contribute 0.
+SIGNALS = ('cf', 'svd', 'content', 'popularity')
+DEFAULT_WEIGHTS = 'cf=0.5,svd=0.2,content=0.2,popularity=0.1'
+SAME_AUTHOR, SAME_GENRE = 1.0, 0.5   # content affinity to the seed book
+
+
+def parse_weights(spec):
+    # "cf=0.5,svd=0.2,..." -> weight vector in SIGNALS order; unnamed signals weigh 0
+    weights = dict.fromkeys(SIGNALS, 0.0)
+    for part in filter(None, (p.strip() for p in spec.split(','))):
+        name, _, value = part.partition('=')
+        if name.strip() not in weights:
+            raise ValueError(f"Unknown ranking signal: {name}")
+        weights[name.strip()] = float(value)
+    return np.asarray([weights[s] for s in SIGNALS], dtype=np.float32)
+
+
+class Budget:
+    # Per-request latency budget: optional stages are skipped once it is spent
+    def __init__(self, ms):
+        self.deadline = time.perf_counter() + ms / 1000
+        self.skipped = []
+
+    def allows(self, stage):
+        if time.perf_counter() < self.deadline:
+            return True
+        self.skipped.append(stage)
+        return False
+
+
+def signal_matrix(n, **rows):
+    # (len(SIGNALS), n) matrix from per-signal arrays; signals that weren't computed are all NaN
+    return np.stack([np.asarray(rows[s], dtype=np.float32) if s in rows else np.full(n, np.nan, dtype=np.float32)
+                     for s in SIGNALS])
+
+
+def lookup_scores(isbns, scores):
+    # {isbn: score} -> float32 array aligned with `isbns`, NaN where missing
+    return np.asarray([scores.get(i, np.nan) for i in isbns], dtype=np.float32)
+
+
+def content_affinity(seed, books):
+    # Same author and/or genre as the seed, from the hydrated book dicts
+    authors = np.asarray([b["author"] or '' for b in books])
+    genres = np.asarray([b["genre"] or '' for b in books])
+    return (SAME_AUTHOR * ((authors == (seed["author"] or '')) & (authors != ''))
+            + SAME_GENRE * ((genres == (seed["genre"] or '')) & (genres != ''))).astype(np.float32)
+
+
+def popularity(counts, averages):
+    # Well rated and often rated; books without ratings score 0
+    counts, averages = np.asarray(counts, dtype=np.float32), np.asarray(averages, dtype=np.float32)
+    return np.log1p(np.nan_to_num(counts)) * np.nan_to_num(averages)
+
+
+def filter_mask(books, genre='all', max_price=None):
+    # The /search filters: exact genre unless 'all', and a price ceiling that excludes unpriced books
+    mask = np.ones(len(books), dtype=bool)
+    if genre != 'all':
+        mask &= np.asarray([b["genre"] == genre for b in books], dtype=bool)
+    if max_price is not None:
+        prices = np.asarray([np.nan if b["price"] is None else b["price"] for b in books], dtype=np.float64)
+        mask &= prices <= max_price  # NaN compares False
+    return mask
+
+
+def blend(signals, weights):
+    # signals: (len(SIGNALS), n) raw scores. Each row is scaled to [0, 1] over the candidates;
+    # a row where every candidate scores the same gives them all full credit.
+    low = np.fmin.reduce(signals, axis=1, keepdims=True)
+    high = np.fmax.reduce(signals, axis=1, keepdims=True)
+    span = high - low
+    scaled = np.where(span > 0, (signals - low) / np.where(span > 0, span, 1), 1.0)
+    return weights @ np.where(np.isnan(signals), 0.0, scaled).astype(np.float32)
+
+
+def rank(signals, weights, mask, n):
+    # Column indices and blended scores of the n best candidates that pass `mask`
+    scores = blend(signals, weights)
+    scores[~mask] = -np.inf
+    ids, best = top_k_neighbors(scores[np.newaxis, :], n)
+    keep = np.isfinite(best[0])
+    return ids[0][keep], best[0][keep]
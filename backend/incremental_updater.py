@@ -0,0 +1,149 @@
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+from scipy import sparse
+
+from model_store import (
+    MODEL_DIR, ModelArtifacts, artifact_path, link_artifacts, new_version_dir, publish_version, save_artifacts,
+    SIMILARITY_FILE, WATERMARK_FILE,
+)
+from content_index import CONTENT_FILES
+from ann_index import ANN_FILES
+from neighbor_index import top_k_neighbors
+from similarity import normalize_rows, rows_per_block, DEFAULT_MEMORY_MB
+from svd_model import SVD_FILES, STARS_TO_MODEL_SCALE
+
+# Folds ratings submitted through /rate into the item-item model without rerunning
+# model_builder.py: only the pivot cells, neighbor rows and similarity entries of the
+# books that received ratings are recomputed, then a new model version is published
+# and running workers hot-swap to it.
+#
+# updated_at is stamped when a rating is flushed, not when its transaction commits, so a
+# rating can become visible with a timestamp older than the watermark. Each run re-reads
+# WATERMARK_OVERLAP_SECONDS behind it and skips the (id, updated_at) pairs the previous
+# run already folded in; the overlap should exceed the longest /rate transaction.
+WATERMARK_OVERLAP_SECONDS = int(os.getenv('WATERMARK_OVERLAP_SECONDS', '300'))
+
+
+def read_watermark(model_path):
+    # (latest updated_at folded in, {(rating id, updated_at)} folded in within the overlap)
+    try:
+        with open(artifact_path(model_path, WATERMARK_FILE)) as f:
+            state = json.load(f)
+    except FileNotFoundError:
+        return None, set()
+    return state.get('ratings_updated_at'), {tuple(seen) for seen in state.get('ratings_seen', [])}
+
+
+def unseen_ratings(ratings, seen):
+    # ratings: [(id, user_id, isbn, rating, updated_at)] -> those not in `seen`
+    return [r for r in ratings if (r[0], r[4].isoformat() if r[4] else None) not in seen]
+
+
+def seen_within_overlap(ratings, latest, overlap=WATERMARK_OVERLAP_SECONDS):
+    # The (id, updated_at) pairs the next run's overlap window will read again
+    if latest is None:
+        return []
+    since = latest - timedelta(seconds=overlap)
+    return sorted({(r[0], r[4].isoformat()) for r in ratings if r[4] and r[4] > since})
+
+
+def apply_ratings(pivot, user_ids, updates):
+    # updates: [(item_row, user_column_id, value)]. Sets pivot cells (idempotent, so replaying
+    # a rating is harmless) and appends columns for users the model hasn't seen.
+    column_of = {int(u): c for c, u in enumerate(user_ids)}
+    new_users = [u for u in dict.fromkeys(u for _, u, _ in updates) if u not in column_of]
+    for u in new_users:
+        column_of[u] = len(column_of)
+    user_ids = np.concatenate([np.asarray(user_ids, dtype=np.int64), np.asarray(new_users, dtype=np.int64)])
+    pivot = sparse.csr_matrix(pivot, shape=(pivot.shape[0], len(user_ids))).tolil()
+    for row, user, value in updates:
+        pivot[row, column_of[user]] = value
+    return pivot.tocsr(), user_ids
+
+
+def update_neighbors(pivot, neighbor_ids, neighbor_scores, affected, similarity=None, memory_mb=DEFAULT_MEMORY_MB):
+    # Recompute the neighbor rows of `affected` items, then merge their new similarities into
+    # every other item's list. Approximate: lists only ever gain/lose the affected items, so a
+    # neighbor that had fallen past the K stored ones can't return. The tail of a list may then
+    # differ from a full rebuild; tests/test_incremental_updater.py pins the served head as exact.
+    normalized = normalize_rows(pivot)
+    n, k = neighbor_ids.shape
+    neighbor_ids, neighbor_scores = np.array(neighbor_ids), np.array(neighbor_scores)
+    step = rows_per_block(n, memory_mb)
+    changed = np.empty((len(affected), n), dtype=np.float32)
+    for start in range(0, len(affected), step):
+        rows = affected[start:start + step]
+        block = (normalized[rows] @ normalized.T).toarray()
+        if similarity is not None:
+            similarity[rows, :] = block
+            similarity[:, rows] = block.T
+        changed[start:start + len(rows)] = block
+        ids, scores = top_k_neighbors(block, k, exclude=rows)
+        neighbor_ids[rows], neighbor_scores[rows] = ids, scores
+
+    others = np.setdiff1d(np.arange(n), affected)
+    for start in range(0, len(others), step):
+        rows = others[start:start + step]
+        old_scores = np.where(np.isin(neighbor_ids[rows], affected), -np.inf, neighbor_scores[rows])
+        candidate_ids = np.hstack([neighbor_ids[rows], np.broadcast_to(affected, (len(rows), len(affected)))])
+        candidate_scores = np.hstack([old_scores, changed[:, rows].T])
+        picked, scores = top_k_neighbors(candidate_scores, k)
+        neighbor_ids[rows] = np.take_along_axis(candidate_ids, picked, axis=1)
+        neighbor_scores[rows] = scores
+    return neighbor_ids, neighbor_scores
+
+
+def run_update(session, Rating, Book, model_dir=MODEL_DIR):
+    # Returns the published version, or None when there was nothing new to fold in.
+    model = ModelArtifacts(model_dir)
+    pivot, user_ids = model.load_pivot()
+    if pivot is None:
+        raise RuntimeError("The live model has no pivot.npz; rerun model_builder.py first.")
+    watermark, seen = read_watermark(model.path)
+
+    query = session.query(Rating.id, Rating.user_id, Book.isbn, Rating.rating, Rating.updated_at).join(Book, Book.id == Rating.book_id).order_by(Rating.updated_at)
+    if watermark:
+        query = query.filter(Rating.updated_at > datetime.fromisoformat(watermark) - timedelta(seconds=WATERMARK_OVERLAP_SECONDS))
+    read = query.all()
+    new_ratings = unseen_ratings(read, seen)
+    if not new_ratings:
+        return None
+
+    rows = model.isbn_map.lookup([isbn for _, _, isbn, _, _ in new_ratings])
+    # App users get negative column ids so they never collide with Book-Crossing User-IDs
+    updates = [(int(row), -user_id, rating * STARS_TO_MODEL_SCALE)
+               for (_, user_id, _, rating, _), row in zip(new_ratings, rows) if row >= 0]
+    # Rows from before updated_at existed have no timestamp; they are folded in until a dated rating sets the watermark
+    # A late commit can be older than the watermark, which never moves back
+    latest = max([r[4] for r in read if r[4]] + ([datetime.fromisoformat(watermark)] if watermark else []), default=None)
+
+    out_dir = new_version_dir(model_dir)
+    affected = np.unique(np.asarray([row for row, _, _ in updates], dtype=np.int64))
+    similarity = None
+    if model.similarity is not None:
+        similarity = np.lib.format.open_memmap(artifact_path(out_dir, SIMILARITY_FILE), mode='w+', dtype=model.similarity.dtype, shape=model.similarity.shape)
+        similarity[:] = model.similarity
+    neighbor_ids, neighbor_scores = model.neighbor_index.neighbor_ids, model.neighbor_index.neighbor_scores
+    if len(affected):
+        pivot, user_ids = apply_ratings(pivot, user_ids, updates)
+        neighbor_ids, neighbor_scores = update_neighbors(pivot, neighbor_ids, neighbor_scores, affected, similarity)
+    if similarity is not None:
+        similarity.flush()
+
+    save_artifacts(out_dir, model.isbns, neighbor_ids, neighbor_scores, pivot=pivot, user_ids=user_ids)
+    link_artifacts(model.path, out_dir, SVD_FILES + CONTENT_FILES + ANN_FILES)
+    with open(artifact_path(out_dir, WATERMARK_FILE), 'w') as f:
+        json.dump({'ratings_updated_at': latest.isoformat() if latest else None, 'ratings_seen': seen_within_overlap(read, latest),
+                   'ratings_applied': len(new_ratings), 'books_updated': len(affected)}, f)
+    return publish_version(model_dir, out_dir)
+
+
+if __name__ == '__main__':
+    from app import app, db, Rating, Book
+
+    with app.app_context():
+        version = run_update(db.session, Rating, Book)
+        print(f"Published model version {version}." if version else "No new ratings since the last update.")
@@ -0,0 +1,174 @@
+import heapq
+import itertools
+import os
+import smtplib
+import threading
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+# Background delivery for transactional mail (OTP codes). Requests only enqueue a message;
+# a small pool of worker threads sends it, each keeping one SMTP connection open between
+# messages. Temporary failures are retried with exponential backoff. Pointing MAIL_HOST at
+# a local stand-in (e.g. `python -m aiosmtpd -n -l localhost:8025` with MAIL_PORT=8025
+# MAIL_SSL=0) exercises the whole path without a real mail server.
+MAIL_HOST = os.getenv('MAIL_HOST', 'smtp.gmail.com')
+MAIL_PORT = int(os.getenv('MAIL_PORT', '465'))
+MAIL_SSL = os.getenv('MAIL_SSL', '1') == '1'
+MAIL_STARTTLS = os.getenv('MAIL_STARTTLS', '0') == '1'
+MAIL_WORKERS = int(os.getenv('MAIL_WORKERS', '2'))
+MAIL_QUEUE_SIZE = int(os.getenv('MAIL_QUEUE_SIZE', '1000'))
+MAIL_MAX_ATTEMPTS = int(os.getenv('MAIL_MAX_ATTEMPTS', '5'))
+MAIL_RETRY_BACKOFF = float(os.getenv('MAIL_RETRY_BACKOFF', '2'))   # seconds before the first retry, doubled after each
+MAIL_IDLE_TIMEOUT = float(os.getenv('MAIL_IDLE_TIMEOUT', '60'))    # close a pooled connection unused for this long
+MAIL_TIMEOUT = float(os.getenv('MAIL_TIMEOUT', '10'))
+
+
+class QueueFull(Exception):
+    pass
+
+
+def build_message(sender, recipient, subject, html):
+    message = MIMEMultipart("alternative")
+    message["Subject"], message["From"], message["To"] = subject, sender, recipient
+    message.attach(MIMEText(html, "html"))
+    return message
+
+
+def is_permanent(error):
+    # 5xx replies (unknown mailbox, message rejected) won't succeed on a retry, nor will a bug
+    if not isinstance(error, OSError) or isinstance(error, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(error, smtplib.SMTPResponseException) and error.smtp_code >= 500 \
+        and not isinstance(error, smtplib.SMTPAuthenticationError)
+
+
+class SmtpConnection:
+    # One reusable SMTP session, reopened when the server has dropped it.
+    def __init__(self, host, port, use_ssl, starttls, username, password, timeout):
+        self.host, self.port, self.use_ssl, self.starttls = host, port, use_ssl, starttls
+        self.username, self.password, self.timeout = username, password, timeout
+        self._server = None
+        self._last_used = 0.0
+
+    def _open(self):
+        server = (smtplib.SMTP_SSL if self.use_ssl else smtplib.SMTP)(self.host, self.port, timeout=self.timeout)
+        if self.starttls and not self.use_ssl:
+            server.starttls()
+        if self.username:
+            server.login(self.username, self.password)
+        return server
+
+    def send(self, sender, recipients, message):
+        if self._server is not None and time.monotonic() - self._last_used > MAIL_IDLE_TIMEOUT:
+            self.close()
+        reused = self._server is not None
+        try:
+            self._send(sender, recipients, message)
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            self.close()
+            if not reused:
+                raise
+            # The server dropped the pooled session while it sat idle; reconnect once
+            self._send(sender, recipients, message)
+        self._last_used = time.monotonic()
+
+    def _send(self, sender, recipients, message):
+        if self._server is None:
+            self._server = self._open()
+        self._server.sendmail(sender, recipients, message)
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except OSError:
+                pass
+            self._server = None
+
+
+class MailQueue:
+    # Messages wait in a heap ordered by when they may be (re)sent; workers start on the
+    # first enqueue, so processes that never send mail (and gunicorn's pre-fork master)
+    # don't run them.
+    def __init__(self, host=MAIL_HOST, port=MAIL_PORT, use_ssl=MAIL_SSL, starttls=MAIL_STARTTLS,
+                 username=None, password=None, workers=MAIL_WORKERS, maxsize=MAIL_QUEUE_SIZE,
+                 max_attempts=MAIL_MAX_ATTEMPTS, backoff=MAIL_RETRY_BACKOFF, timeout=MAIL_TIMEOUT):
+        self.connection_args = (host, port, use_ssl, starttls, username, password, timeout)
+        self.sender = username
+        self.workers = workers
+        self.maxsize = maxsize
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._heap = []
+        self._sequence = itertools.count()
+        self._in_flight = 0
+        self._condition = threading.Condition()
+        self._threads = []
+        self._pid = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _start(self):
+        # Called with the condition held; restarts the pool in a forked child
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._threads = [threading.Thread(target=self._work, name=f'mail-worker-{i}', daemon=True) for i in range(self.workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def send(self, recipient, subject, html):
+        message = build_message(self.sender, recipient, subject, html).as_string()
+        with self._condition:
+            if len(self._heap) >= self.maxsize:
+                raise QueueFull("Mail queue is full")
+            self._start()
+            heapq.heappush(self._heap, (time.monotonic(), next(self._sequence), recipient, message, 1))
+            self._condition.notify()
+
+    def _next(self):
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                if self._heap and self._heap[0][0] <= now:
+                    self._in_flight += 1
+                    return heapq.heappop(self._heap)
+                self._condition.wait(self._heap[0][0] - now if self._heap else None)
+
+    def _work(self):
+        connection = SmtpConnection(*self.connection_args)
+        while True:
+            _, _, recipient, message, attempt = self._next()
+            try:
+                connection.send(self.sender, [recipient], message)
+                outcome = 'sent'
+            except Exception as e:
+                if is_permanent(e) or attempt >= self.max_attempts:
+                    print(f"Email to {recipient} failed after {attempt} attempt(s): {e}")
+                    outcome = 'failed'
+                else:
+                    outcome = 'retried'
+                    delay = self.backoff * 2 ** (attempt - 1)
+                    with self._condition:
+                        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._sequence), recipient, message, attempt + 1))
+            with self._condition:
+                self._in_flight -= 1
+                setattr(self, outcome, getattr(self, outcome) + 1)
+                self._condition.notify_all()
+
+    def pending(self):
+        with self._condition:
+            return len(self._heap) + self._in_flight
+
+    def join(self, timeout=None):
+        # Wait until every queued message is sent or given up on; False on timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._heap or self._in_flight:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
@@ -1,94 +1,111 @@
-import pandas as pd
-import numpy as np
-
-# Load the datasets
-books = pd.read_csv('Books.csv', low_memory=False)
-ratings = pd.read_csv('Ratings.csv')
-
-# Merge the two dataframes on the 'ISBN' column
-df = ratings.merge(books, on='ISBN')
-
-# --- Start of New Code ---
-
-# 1. Filter by number of ratings per book
-# First, count how many ratings each book has
-ratings_count = df.groupby('Book-Title').count()['Book-Rating'].reset_index()
-ratings_count.rename(columns={'Book-Rating': 'num_ratings'}, inplace=True)
-
-# We only want books with 50 or more ratings
-popular_books = ratings_count[ratings_count['num_ratings'] >= 50]['Book-Title']
-
-# Filter our main dataframe to only include these popular books
-popular_df = df[df['Book-Title'].isin(popular_books)]
-
-# 2. Filter by number of ratings per user
-# Now, count how many ratings each user has given
-user_ratings_count = popular_df.groupby('User-ID').count()['Book-Rating'].reset_index()
-user_ratings_count.rename(columns={'Book-Rating': 'num_user_ratings'}, inplace=True)
-
-# We only want users who have given 200 or more ratings
-active_users = user_ratings_count[user_ratings_count['num_user_ratings'] >= 200]['User-ID']
-
-# Filter our popular dataframe to only include these active users
-final_df = popular_df[popular_df['User-ID'].isin(active_users)]
-
-# Print the shape of our new, smaller, and cleaner dataframe
-print("Shape of original dataframe:", df.shape)
-print("Shape after filtering for popular books:", popular_df.shape)
-print("Shape of final dataframe with active users:", final_df.shape)
-
-# Display the first 5 rows of our final dataframe
-print("\nFinal Dataframe:")
-print(final_df.head())
-
-
-# --- Start of New Code for Model Building ---
+import os
 
-# Create a pivot table: rows are book titles, columns are users, values are ratings
-book_pivot = final_df.pivot_table(index='ISBN', columns='User-ID', values='Book-Rating')
-# Fill missing values (where a user hasn't rated a book) with 0
-book_pivot.fillna(0, inplace=True)
-
-# Print the shape of our pivot table
-print("\nShape of our pivot table:", book_pivot.shape)
-print(book_pivot.head())
-
-# --- Calculate Similarity ---
-from sklearn.metrics.pairwise import cosine_similarity
-
-# Calculate the cosine similarity between every book
-similarity_scores = cosine_similarity(book_pivot)
-
-# Print the shape of our similarity matrix
-print("\nShape of our similarity matrix:", similarity_scores.shape)
-
-
-import pickle
-
-# --- Start of Final Code ---
-
-def recommend(book_name):
-    # Find the index of the book that is passed in
-    try:
-        index = book_pivot.index.get_loc(book_name)
-    except KeyError:
-        return "Sorry, this book is not in our dataset. Please try another."
-
-    # Get the similarity scores for that book with all other books
-    similar_books = sorted(list(enumerate(similarity_scores[index])), key=lambda x: x[1], reverse=True)[1:6]
-
-    # Print the titles of the top 5 most similar books
-    recommendations = []
-    for i in similar_books:
-        recommendations.append(book_pivot.index[i[0]])
-
-    return recommendations
-
-# --- Test the function ---
-book_isbn_to_test = '000648302X'
-print(f"\nRecommendations for book with ISBN '{book_isbn_to_test}':")
-print(recommend(book_isbn_to_test))
-
-# --- Save the necessary objects for our API ---
-pickle.dump(book_pivot, open('pivot.pkl', 'wb'))
-pickle.dump(similarity_scores, open('similarity_scores.pkl', 'wb'))
\ No newline at end of file
+import numpy as np
+from neighbor_index import build_neighbor_index, DEFAULT_K
+from similarity import build_sparse_pivot, blocked_cosine_neighbors, DEFAULT_MEMORY_MB
+from preprocess import load_prepared, MIN_BOOK_RATINGS, MIN_USER_RATINGS, PREPARED_DIR
+from content_index import build_content_index, CATALOG_CSV
+from ann_index import build_ann_index, DEFAULT_DIM
+from model_store import MODEL_DIR, SIMILARITY_FILE, ModelArtifacts, artifact_path, save_artifacts, new_version_dir, publish_version, current_model_path, link_artifacts
+from svd_model import SVD_FILES
+
+# --- Build Settings ---
+# 'sparse' computes similarity in bounded-memory blocks over a CSR pivot,
+# 'dense' is the original pivot_table + cosine_similarity path.
+SIMILARITY_MODE = os.getenv('SIMILARITY_MODE', 'sparse')
+SIMILARITY_MEMORY_MB = int(os.getenv('SIMILARITY_MEMORY_MB', str(DEFAULT_MEMORY_MB)))
+SIMILARITY_WORKERS = int(os.getenv('SIMILARITY_WORKERS', '1'))
+# Set to 1 to also write the full n x n similarity matrix in sparse mode (dense mode always does).
+SIMILARITY_DENSE = os.getenv('SIMILARITY_DENSE', '0') == '1'
+# Set to 1 to rank the content fallback's author/genre candidates by TF-IDF over title + publisher.
+CONTENT_TFIDF = os.getenv('CONTENT_TFIDF', '0') == '1'
+# Set to 1 to also build the approximate nearest-neighbor index (ann_index.py) over every
+# book with ANN_MIN_BOOK_RATINGS ratings, not just the ones that pass MIN_BOOK_RATINGS.
+ANN_INDEX = os.getenv('ANN_INDEX', '0') == '1'
+ANN_MIN_BOOK_RATINGS = int(os.getenv('ANN_MIN_BOOK_RATINGS', '1'))
+ANN_MIN_USER_RATINGS = int(os.getenv('ANN_MIN_USER_RATINGS', '2'))  # a single rating links no books
+ANN_DIM = int(os.getenv('ANN_DIM', str(DEFAULT_DIM)))
+ANN_LISTS = int(os.getenv('ANN_LISTS', '0'))  # 0 = about 4 * sqrt(books)
+ANN_RECALL_SAMPLE = int(os.getenv('ANN_RECALL_SAMPLE', '1000'))
+
+
+def build_dense(final_df, out_dir):
+    # Create a pivot table: rows are ISBNs, columns are users, values are ratings
+    book_pivot = final_df.pivot_table(index='ISBN', columns='User-ID', values='Book-Rating')
+    # Fill missing values (where a user hasn't rated a book) with 0
+    book_pivot.fillna(0, inplace=True)
+    print("\nShape of our pivot table:", book_pivot.shape)
+
+    # --- Calculate Similarity ---
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    # Calculate the cosine similarity between every book
+    similarity_scores = cosine_similarity(book_pivot)
+    print("\nShape of our similarity matrix:", similarity_scores.shape)
+
+    np.save(artifact_path(out_dir, SIMILARITY_FILE), similarity_scores)
+
+    neighbor_ids, neighbor_scores = build_neighbor_index(similarity_scores, k=DEFAULT_K)
+    return book_pivot.index.to_numpy(), book_pivot.to_numpy(), book_pivot.columns.to_numpy(), neighbor_ids, neighbor_scores
+
+
+def build_sparse(final_df, out_dir):
+    # CSR pivot: memory grows with the number of ratings, not books x users
+    book_pivot, isbns, user_ids = build_sparse_pivot(final_df)
+    print("\nShape of our pivot table:", book_pivot.shape, "non-zeros:", book_pivot.nnz)
+
+    # Blocked cosine similarity, each block bounded by SIMILARITY_MEMORY_MB per worker
+    dense_out = artifact_path(out_dir, SIMILARITY_FILE) if SIMILARITY_DENSE else None
+    neighbor_ids, neighbor_scores = blocked_cosine_neighbors(
+        book_pivot, k=DEFAULT_K, memory_mb=SIMILARITY_MEMORY_MB,
+        workers=SIMILARITY_WORKERS, dense_out=dense_out)
+    return isbns, book_pivot, user_ids, neighbor_ids, neighbor_scores
+
+
+def build_ann(out_dir):
+    # Its own preprocessed copy, so the relaxed thresholds don't evict the main one
+    ann_df = load_prepared(ANN_MIN_BOOK_RATINGS, ANN_MIN_USER_RATINGS, out_dir=os.path.join(PREPARED_DIR, 'ann'))
+    pivot, isbns, _ = build_sparse_pivot(ann_df)
+    meta = build_ann_index(out_dir, isbns, pivot, dim=ANN_DIM, n_lists=ANN_LISTS or None, recall_sample=ANN_RECALL_SAMPLE)
+    print(f"\nANN index: {meta['books']} books, {meta['lists']} lists of {meta['dim']}-d vectors")
+    for row in meta['recall']:
+        print("  " + ", ".join(f"{key} {value}" for key, value in row.items()))
+
+
+def main():
+    # Popular books rated by active users, from the streaming preprocessing stage shared with surprise_model_builder.py
+    final_df = load_prepared(MIN_BOOK_RATINGS, MIN_USER_RATINGS)
+    out_dir = new_version_dir(MODEL_DIR)
+
+    if SIMILARITY_MODE == 'dense':
+        isbns, pivot, user_ids, neighbor_ids, neighbor_scores = build_dense(final_df, out_dir)
+    else:
+        isbns, pivot, user_ids, neighbor_ids, neighbor_scores = build_sparse(final_df, out_dir)
+
+    # --- Save the memory-mappable model artifacts and make them the live version ---
+    save_artifacts(out_dir, isbns, neighbor_ids, neighbor_scores, pivot=pivot, user_ids=user_ids)
+    # Content index over the whole catalog for books outside the pivot
+    if os.path.exists(CATALOG_CSV):
+        print("\nContent index built for", build_content_index(out_dir, CATALOG_CSV, tfidf=CONTENT_TFIDF), "catalog books")
+    else:
+        print(f"\n{CATALOG_CSV} not found; /recommend will query the database for cold-start books.")
+    if ANN_INDEX:
+        build_ann(out_dir)
+    # Keep the SVD factors from surprise_model_builder.py (keyed by title, so still valid for the new pivot)
+    link_artifacts(current_model_path(MODEL_DIR), out_dir, SVD_FILES)
+    version = publish_version(MODEL_DIR, out_dir)
+    print(f"\nModel version {version} published to {MODEL_DIR}/")
+    print("\nShape of our neighbor index:", neighbor_ids.shape)
+
+    # --- Test the artifacts the way app.py loads them ---
+    book_isbn_to_test = '000648302X'
+    print(f"\nRecommendations for book with ISBN '{book_isbn_to_test}':")
+    index = ModelArtifacts(MODEL_DIR).neighbor_index
+    if book_isbn_to_test in index:
+        print([isbn for isbn, score in index.neighbors(book_isbn_to_test, 5)])
+    else:
+        print("Sorry, this book is not in our dataset. Please try another.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import os
+import shutil
+from datetime import datetime
+
+import numpy as np
+from scipy import sparse
+
+from neighbor_index import NeighborIndex
+
+# Directory holding the model artifacts written by model_builder.py.
+# Every array is a plain .npy file so app.py can open it with mmap: gunicorn
+# workers then share the same pages through the OS page cache.
+MODEL_DIR = os.getenv('MODEL_DIR', 'model')
+
+ISBNS_FILE = 'isbns.npy'                      # row -> ISBN
+ISBN_KEYS_FILE = 'isbn_keys.npy'              # sorted ISBNs  } ISBN -> row mapping,
+ISBN_ROWS_FILE = 'isbn_rows.npy'              # row of each key } resolved with searchsorted
+NEIGHBOR_IDS_FILE = 'neighbor_ids.npy'        # (n, K) int32
+NEIGHBOR_SCORES_FILE = 'neighbor_scores.npy'  # (n, K) float32
+SIMILARITY_FILE = 'similarity.npy'            # optional (n, n) float64
+PIVOT_FILE = 'pivot.npz'                      # optional CSR ISBN x user ratings
+USER_IDS_FILE = 'user_ids.npy'                # column -> User-ID of the pivot (app users are -user.id)
+WATERMARK_FILE = 'watermark.json'             # last live rating folded in by incremental_updater.py
+MODEL_FILES = [ISBNS_FILE, ISBN_KEYS_FILE, ISBN_ROWS_FILE, NEIGHBOR_IDS_FILE, NEIGHBOR_SCORES_FILE,
+               SIMILARITY_FILE, PIVOT_FILE, USER_IDS_FILE, WATERMARK_FILE]
+
+# Published versions live in MODEL_DIR/versions/<version>/; MODEL_DIR/CURRENT names the
+# live one and is swapped atomically, so workers can hot-reload. A MODEL_DIR without
+# CURRENT holds a single unversioned set of artifacts.
+VERSIONS_DIR = 'versions'
+CURRENT_FILE = 'CURRENT'
+KEEP_VERSIONS = int(os.getenv('MODEL_KEEP_VERSIONS', '3'))
+
+
+def artifact_path(model_dir, name):
+    return os.path.join(model_dir, name)
+
+
+def current_version(model_dir):
+    try:
+        with open(os.path.join(model_dir, CURRENT_FILE)) as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def version_path(model_dir, version):
+    return os.path.join(model_dir, VERSIONS_DIR, version) if version else model_dir
+
+
+def current_model_path(model_dir):
+    return version_path(model_dir, current_version(model_dir))
+
+
+def new_version_dir(model_dir):
+    # Staging directory for the next version; publish_version() makes it live.
+    version = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    path = os.path.join(model_dir, VERSIONS_DIR, version + '.tmp')
+    os.makedirs(path)
+    return path
+
+
+def publish_version(model_dir, staging_path):
+    final_path = staging_path[:-len('.tmp')]
+    os.replace(staging_path, final_path)
+    version = os.path.basename(final_path)
+    pointer = os.path.join(model_dir, CURRENT_FILE)
+    with open(pointer + '.tmp', 'w') as f:
+        f.write(version)
+    os.replace(pointer + '.tmp', pointer)
+    prune_versions(model_dir, keep=version)
+    return version
+
+
+def prune_versions(model_dir, keep, count=KEEP_VERSIONS):
+    # Workers still mapping a removed version keep their pages until they reload.
+    root = os.path.join(model_dir, VERSIONS_DIR)
+    versions = sorted(v for v in os.listdir(root) if not v.endswith('.tmp') and v != keep)
+    for old in versions[:max(len(versions) - (count - 1), 0)]:
+        shutil.rmtree(os.path.join(root, old), ignore_errors=True)
+
+
+def link_artifacts(src_dir, dst_dir, names):
+    # Carry unchanged artifacts into a new version without copying their bytes.
+    for name in names:
+        src = artifact_path(src_dir, name)
+        if not os.path.exists(src):
+            continue
+        try:
+            os.link(src, artifact_path(dst_dir, name))
+        except OSError:
+            shutil.copy2(src, artifact_path(dst_dir, name))
+
+
+def save_artifacts(model_dir, isbns, neighbor_ids, neighbor_scores, pivot=None, user_ids=None):
+    os.makedirs(model_dir, exist_ok=True)
+    isbns = np.asarray([str(i).strip() for i in isbns])
+    order = np.argsort(isbns, kind='stable')
+    np.save(artifact_path(model_dir, ISBNS_FILE), isbns)
+    np.save(artifact_path(model_dir, ISBN_KEYS_FILE), isbns[order])
+    np.save(artifact_path(model_dir, ISBN_ROWS_FILE), order.astype(np.int32))
+    np.save(artifact_path(model_dir, NEIGHBOR_IDS_FILE), np.asarray(neighbor_ids, dtype=np.int32))
+    np.save(artifact_path(model_dir, NEIGHBOR_SCORES_FILE), np.asarray(neighbor_scores, dtype=np.float32))
+    if pivot is not None:
+        sparse.save_npz(artifact_path(model_dir, PIVOT_FILE), sparse.csr_matrix(pivot))
+    if user_ids is not None:
+        np.save(artifact_path(model_dir, USER_IDS_FILE), np.asarray(user_ids))
+
+
+def _mmap(model_dir, name, required=True):
+    path = artifact_path(model_dir, name)
+    if not required and not os.path.exists(path):
+        return None
+    return np.load(path, mmap_mode='r')
+
+
+class IsbnMap:
+    def __init__(self, keys, rows):
+        self.keys = keys
+        self.rows = rows
+
+    def _position(self, isbn):
+        isbn = str(isbn).strip()
+        pos = int(np.searchsorted(self.keys, isbn))
+        if pos < len(self.keys) and self.keys[pos] == isbn:
+            return pos
+        return None
+
+    def __contains__(self, isbn):
+        return self._position(isbn) is not None
+
+    def row(self, isbn):
+        pos = self._position(isbn)
+        if pos is None:
+            raise KeyError(isbn)
+        return int(self.rows[pos])
+
+    def lookup(self, isbns):
+        # Vectorized version of row(): -1 for ISBNs that are not in the model.
+        isbns = np.asarray([str(i).strip() for i in isbns], dtype=self.keys.dtype)
+        if len(self.keys) == 0:
+            return np.full(len(isbns), -1, dtype=np.int64)
+        pos = np.minimum(np.searchsorted(self.keys, isbns), len(self.keys) - 1)
+        return np.where(self.keys[pos] == isbns, self.rows[pos], -1).astype(np.int64)
+
+
+class ModelArtifacts:
+    def __init__(self, model_dir=MODEL_DIR):
+        self.model_dir = model_dir
+        self.version = current_version(model_dir)
+        self.path = path = version_path(model_dir, self.version)
+        self.isbns = _mmap(path, ISBNS_FILE)
+        self.isbn_map = IsbnMap(_mmap(path, ISBN_KEYS_FILE), _mmap(path, ISBN_ROWS_FILE))
+        self.neighbor_index = NeighborIndex(
+            self.isbns, _mmap(path, NEIGHBOR_IDS_FILE), _mmap(path, NEIGHBOR_SCORES_FILE), self.isbn_map)
+        self.similarity = _mmap(path, SIMILARITY_FILE, required=False)
+
+    def is_stale(self):
+        return current_version(self.model_dir) != self.version
+
+    def load_pivot(self):
+        # Not memory-mapped (CSR in .npz); only the offline builders need it.
+        path = artifact_path(self.path, PIVOT_FILE)
+        if not os.path.exists(path):
+            return None, None
+        user_ids = np.load(artifact_path(self.path, USER_IDS_FILE))
+        return sparse.load_npz(path).tocsr(), user_ids
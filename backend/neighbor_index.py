@@ -0,0 +1,57 @@
+import numpy as np
+
+# Number of neighbors kept per book. /recommend only serves 5, the rest is
+# headroom so filtered-out or missing books can be skipped.
+DEFAULT_K = 20
+
+
+def top_k_neighbors(scores, k, exclude=None):
+    # Pick the k best columns of every row of `scores` without sorting the whole row.
+    # `exclude` holds one column per row (usually the book itself) that must never be returned.
+    scores = np.asarray(scores)
+    if exclude is not None:
+        scores = scores.astype(np.float64 if scores.dtype == np.float64 else np.float32, copy=True)
+        scores[np.arange(scores.shape[0]), exclude] = -np.inf
+    k = min(k, scores.shape[1] - (1 if exclude is not None else 0))
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int32), np.empty((scores.shape[0], 0), dtype=np.float32)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    part_scores = np.take_along_axis(scores, part, axis=1)
+    order = np.argsort(-part_scores, axis=1, kind='stable')
+    ids = np.take_along_axis(part, order, axis=1).astype(np.int32)
+    return ids, np.take_along_axis(part_scores, order, axis=1).astype(np.float32)
+
+
+def build_neighbor_index(similarity_scores, k=DEFAULT_K, chunk_size=1024):
+    # Turn a dense n x n similarity matrix into (n x k) int32 ids + float32 scores.
+    n = similarity_scores.shape[0]
+    k = min(k, max(n - 1, 0))
+    neighbor_ids = np.empty((n, k), dtype=np.int32)
+    neighbor_scores = np.empty((n, k), dtype=np.float32)
+    for start in range(0, n, chunk_size):
+        stop = min(start + chunk_size, n)
+        ids, scores = top_k_neighbors(similarity_scores[start:stop], k, exclude=np.arange(start, stop))
+        neighbor_ids[start:stop], neighbor_scores[start:stop] = ids, scores
+    return neighbor_ids, neighbor_scores
+
+
+class NeighborIndex:
+    # `isbn_map` resolves an ISBN to its row (see model_store.IsbnMap); the arrays
+    # are usually read-only memmaps shared by every worker process.
+    def __init__(self, isbns, neighbor_ids, neighbor_scores, isbn_map):
+        self.isbns = isbns
+        self.neighbor_ids = neighbor_ids
+        self.neighbor_scores = neighbor_scores
+        self.isbn_map = isbn_map
+
+    def __contains__(self, isbn):
+        return isbn in self.isbn_map
+
+    def __len__(self):
+        return len(self.isbns)
+
+    def neighbors(self, isbn, n=5):
+        # O(K) lookup: the row is already sorted by score, so just slice it.
+        row = self.isbn_map.row(isbn)
+        ids = self.neighbor_ids[row, :n]
+        return [(str(self.isbns[i]), float(s)) for i, s in zip(ids, self.neighbor_scores[row, :n])]
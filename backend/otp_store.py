@@ -0,0 +1,202 @@
+import hmac
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+# One-time codes for e-mail verification and password reset. Codes expire after
+# OTP_TTL seconds and allow OTP_MAX_ATTEMPTS guesses before they are discarded;
+# at most OTP_MAX_ISSUES codes are sent per key every OTP_ISSUE_WINDOW seconds.
+# The SQL and Redis backends are shared by every gunicorn worker; the in-memory one
+# only suits a single process.
+OTP_TTL = int(os.getenv('OTP_TTL', '600'))
+OTP_MAX_ATTEMPTS = int(os.getenv('OTP_MAX_ATTEMPTS', '5'))
+OTP_MAX_ISSUES = int(os.getenv('OTP_MAX_ISSUES', '5'))
+OTP_ISSUE_WINDOW = int(os.getenv('OTP_ISSUE_WINDOW', '900'))
+OTP_EVICT_INTERVAL = int(os.getenv('OTP_EVICT_INTERVAL', '60'))
+# Dialects whose INSERT ... ON CONFLICT DO NOTHING creates a key's row race-free
+ROW_INSERTS = {'postgresql': pg_insert, 'sqlite': sqlite_insert}
+
+
+class TooManyRequests(Exception):
+    # Raised by issue() when a key has been sent too many codes within the window.
+    pass
+
+
+class TooManyAttempts(Exception):
+    # Raised by verify() once a code has been guessed wrong too often; the code is gone.
+    pass
+
+
+def _matches(expected, code):
+    return expected is not None and code is not None and hmac.compare_digest(str(expected), str(code))
+
+
+class MemoryOtpStore:
+    def __init__(self, ttl=OTP_TTL, max_attempts=OTP_MAX_ATTEMPTS, max_issues=OTP_MAX_ISSUES,
+                 issue_window=OTP_ISSUE_WINDOW, evict_interval=OTP_EVICT_INTERVAL):
+        self.ttl, self.max_attempts, self.max_issues, self.issue_window = ttl, max_attempts, max_issues, issue_window
+        self._entries = {}  # key -> {code, expires_at, attempts, issued, window_started}
+        self._lock = threading.Lock()
+        self._evict_interval = evict_interval
+        threading.Thread(target=self._evict_forever, name='otp-evictor', daemon=True).start()
+
+    def issue(self, key, code):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry['window_started'] + self.issue_window <= now:
+                entry = self._entries[key] = {'issued': 0, 'window_started': now}
+            if entry['issued'] >= self.max_issues:
+                raise TooManyRequests(key)
+            entry.update(code=code, expires_at=now + self.ttl, attempts=0, issued=entry['issued'] + 1)
+
+    def verify(self, key, code):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry.get('code') is None or entry['expires_at'] <= time.time():
+                return False
+            if _matches(entry['code'], code):
+                entry['code'] = None
+                return True
+            entry['attempts'] += 1
+            if entry['attempts'] >= self.max_attempts:
+                entry['code'] = None
+                raise TooManyAttempts(key)
+            return False
+
+    def evict(self):
+        # Entries are kept past their code's expiry until the issue window has passed too
+        now = time.time()
+        with self._lock:
+            expired = [k for k, e in self._entries.items()
+                       if e.get('expires_at', 0) <= now and e['window_started'] + self.issue_window <= now]
+            for key in expired:
+                del self._entries[key]
+        return len(expired)
+
+    def _evict_forever(self):
+        while True:
+            time.sleep(self._evict_interval)
+            self.evict()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SqlOtpStore:
+    # `model` is a table with key, code, expires_at, attempts, issued and window_started
+    # columns (app.OtpCode). Rows are locked while they are read and updated. issue() evicts
+    # stale rows as it goes; `flask evict-otp-codes` sweeps the table when codes stop being sent.
+    def __init__(self, session, model, ttl=OTP_TTL, max_attempts=OTP_MAX_ATTEMPTS, max_issues=OTP_MAX_ISSUES,
+                 issue_window=OTP_ISSUE_WINDOW):
+        self.session, self.model = session, model
+        self.ttl, self.max_attempts, self.max_issues, self.issue_window = ttl, max_attempts, max_issues, issue_window
+
+    def _row(self, key):
+        return self.session.query(self.model).filter_by(key=key).with_for_update().first()
+
+    def _ensure_row(self, key, now):
+        # Concurrent first issues for a key both try to create its row; the loser's insert is a no-op
+        insert = ROW_INSERTS.get(self.session.get_bind().dialect.name)
+        if insert is not None:
+            self.session.execute(insert(self.model).values(key=key, issued=0, attempts=0, window_started=now)
+                                 .on_conflict_do_nothing(index_elements=['key']))
+
+    def issue(self, key, code):
+        now = datetime.utcnow()
+        self.evict(commit=False)
+        self._ensure_row(key, now)
+        row = self._row(key)
+        if row is None:
+            row = self.model(key=key, issued=0, window_started=now)
+            self.session.add(row)
+        elif row.window_started + timedelta(seconds=self.issue_window) <= now:
+            row.issued, row.window_started = 0, now
+        if row.issued >= self.max_issues:
+            self.session.rollback()
+            raise TooManyRequests(key)
+        row.code, row.expires_at, row.attempts, row.issued = code, now + timedelta(seconds=self.ttl), 0, row.issued + 1
+        self.session.commit()
+
+    def verify(self, key, code):
+        row = self._row(key)
+        if row is None or row.code is None or row.expires_at <= datetime.utcnow():
+            self.session.rollback()
+            return False
+        if _matches(row.code, code):
+            row.code = None
+            self.session.commit()
+            return True
+        row.attempts += 1
+        locked = row.attempts >= self.max_attempts
+        if locked:
+            row.code = None
+        self.session.commit()
+        if locked:
+            raise TooManyAttempts(key)
+        return False
+
+    def evict(self, commit=True):
+        cutoff = datetime.utcnow() - timedelta(seconds=self.issue_window)
+        deleted = self.session.query(self.model).filter(self.model.expires_at < cutoff).delete(synchronize_session=False)
+        if commit:
+            self.session.commit()
+        return deleted
+
+
+class RedisOtpStore:
+    # Codes, attempt counters and issue counters are separate keys with their own expiry,
+    # so the server does the eviction.
+    def __init__(self, url, ttl=OTP_TTL, max_attempts=OTP_MAX_ATTEMPTS, max_issues=OTP_MAX_ISSUES,
+                 issue_window=OTP_ISSUE_WINDOW, prefix='otp'):
+        import redis  # optional dependency, only needed when OTP_STORE is a redis:// URL
+
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self.ttl, self.max_attempts, self.max_issues, self.issue_window = ttl, max_attempts, max_issues, issue_window
+        self.prefix = prefix
+
+    def _keys(self, key):
+        return f"{self.prefix}:{key}:code", f"{self.prefix}:{key}:attempts", f"{self.prefix}:{key}:issued"
+
+    def issue(self, key, code):
+        code_key, attempts_key, issued_key = self._keys(key)
+        pipe = self._redis.pipeline()
+        pipe.incr(issued_key)
+        pipe.expire(issued_key, self.issue_window, nx=True)
+        issued, _ = pipe.execute()
+        if issued > self.max_issues:
+            raise TooManyRequests(key)
+        pipe = self._redis.pipeline()
+        pipe.set(code_key, code, ex=self.ttl)
+        pipe.delete(attempts_key)
+        pipe.execute()
+
+    def verify(self, key, code):
+        code_key, attempts_key, _ = self._keys(key)
+        expected = self._redis.get(code_key)
+        if expected is None:
+            return False
+        if _matches(expected, code):
+            # Only one concurrent verify can delete the code
+            return self._redis.delete(code_key) == 1
+        pipe = self._redis.pipeline()
+        pipe.incr(attempts_key)
+        pipe.expire(attempts_key, self.ttl)
+        attempts, _ = pipe.execute()
+        if attempts >= self.max_attempts:
+            self._redis.delete(code_key, attempts_key)
+            raise TooManyAttempts(key)
+        return False
+
+
+def make_otp_store(backend, session=None, model=None):
+    # backend: 'sql' (default), 'memory', or a redis:// URL
+    if backend.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisOtpStore(backend)
+    if backend == 'memory':
+        return MemoryOtpStore()
+    return SqlOtpStore(session, model)
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional: without it photos are stored as uploaded, with no thumbnail
+    Image = None
+
+# Profile photos are spooled to a temp file while the request body is read, checked from
+# their header, and answered with 202. Decoding, downscaling, the thumbnail and the storage
+# uploads run on a worker pool, so request workers never hold the image in memory or wait on
+# the storage service. Pillow releases the GIL while it decodes and resamples, so the pool's
+# threads resize in parallel without the cost (and fork/spawn pitfalls) of a process pool.
+PHOTO_MAX_BYTES = int(os.getenv('PHOTO_MAX_BYTES', str(10 * 1024 * 1024)))
+PHOTO_MAX_SIZE = int(os.getenv('PHOTO_MAX_SIZE', '1024'))     # longest side of the stored photo
+PHOTO_THUMB_SIZE = int(os.getenv('PHOTO_THUMB_SIZE', '150'))
+PHOTO_MAX_PIXELS = int(os.getenv('PHOTO_MAX_PIXELS', str(40_000_000)))
+PHOTO_WORKERS = int(os.getenv('PHOTO_WORKERS', '2'))
+
+
+class InvalidPhoto(Exception):
+    pass
+
+
+def probe(path):
+    # Reads only the image header; raises InvalidPhoto for anything we won't decode.
+    if Image is None:
+        return
+    try:
+        with Image.open(path) as image:
+            width, height = image.size
+    except (OSError, Image.DecompressionBombError) as e:
+        raise InvalidPhoto(f"Not a supported image: {e}")
+    if width * height > PHOTO_MAX_PIXELS:
+        raise InvalidPhoto(f"Image is too large ({width}x{height}).")
+
+
+def resize(source_path, out_dir, max_size=PHOTO_MAX_SIZE, thumb_size=PHOTO_THUMB_SIZE):
+    # One decode, then the photo and its thumbnail as JPEG.
+    with Image.open(source_path) as image:
+        image.draft('RGB', (max_size, max_size))  # JPEG decoders can downscale by up to 8x while decoding
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    image.thumbnail((max_size, max_size))
+    photo = os.path.join(out_dir, 'photo.jpg')
+    image.save(photo, 'JPEG', quality=85, optimize=True)
+    image.thumbnail((thumb_size, thumb_size))
+    thumb = os.path.join(out_dir, 'thumb.jpg')
+    image.save(thumb, 'JPEG', quality=85)
+    return photo, thumb
+
+
+def photo_paths(folder, stem, extension):
+    # Object paths for the photo and its thumbnail (None when Pillow isn't installed)
+    if Image is None:
+        return f"{folder}/{stem}.{extension}", None
+    return f"{folder}/{stem}.jpg", f"{folder}/{stem}_thumb.jpg"
+
+
+class PhotoPipeline:
+    def __init__(self, storage, workers=PHOTO_WORKERS):
+        self.storage = storage
+        self.workers = workers
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='photo-worker')
+
+    def submit(self, source_path, path, thumb_path, content_type, on_done):
+        # Takes ownership of source_path; on_done() runs once everything is stored
+        return self._pool.submit(self._run, source_path, path, thumb_path, content_type, on_done)
+
+    def _run(self, source_path, path, thumb_path, content_type, on_done):
+        work_dir = tempfile.mkdtemp(prefix='photo-')
+        try:
+            if Image is None:
+                self.storage.upload(path, source_path, content_type)
+            else:
+                photo, thumb = resize(source_path, work_dir)
+                self.storage.upload(thumb_path, thumb, 'image/jpeg')
+                self.storage.upload(path, photo, 'image/jpeg')
+            on_done()
+        except Exception as e:
+            print(f"PHOTO UPLOAD FAILED ({path}): {e}")
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+            os.remove(source_path)
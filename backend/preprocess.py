@@ -0,0 +1,117 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+# Shared preprocessing for model_builder.py and surprise_model_builder.py.
+# Books.csv and Ratings.csv are streamed in chunks with explicit dtypes; the
+# per-book and per-user rating counts are accumulated across chunks, so only
+# the filtered ratings are ever held in memory. The result is written as
+# columnar .npy files and reused by both builders until the CSVs or the
+# thresholds change.
+
+PREPARED_DIR = os.getenv('PREPARED_DIR', 'prepared')
+# Books need this many ratings and users this many ratings of those books to be kept
+MIN_BOOK_RATINGS = int(os.getenv('MIN_BOOK_RATINGS', '50'))
+MIN_USER_RATINGS = int(os.getenv('MIN_USER_RATINGS', '200'))
+CHUNK_SIZE = int(os.getenv('PREPROCESS_CHUNK_SIZE', '200000'))
+BOOKS_CSV = 'Books.csv'
+RATINGS_CSV = 'Ratings.csv'
+
+BOOK_DTYPES = {'ISBN': str, 'Book-Title': str}
+RATING_DTYPES = {'User-ID': np.int32, 'ISBN': str, 'Book-Rating': np.int8}
+META_FILE = 'meta.json'
+
+
+def _read_books(books_csv):
+    # Only the two columns the builders need; the first row wins for a repeated ISBN.
+    books = pd.concat(pd.read_csv(books_csv, usecols=list(BOOK_DTYPES), dtype=BOOK_DTYPES, chunksize=CHUNK_SIZE))
+    # Untitled books could never pass the per-title filter, so they are dropped up front.
+    books = books.drop_duplicates(subset='ISBN').dropna(subset=['Book-Title'])
+    title_codes, titles = pd.factorize(books['Book-Title'])
+    return pd.Index(books['ISBN'].to_numpy()), title_codes.astype(np.int32), np.asarray(titles, dtype=str)
+
+
+def _rating_chunks(ratings_csv, book_index):
+    # Yields (user_ids, book_rows, ratings) per chunk; ratings for unknown ISBNs are dropped like the inner merge did.
+    for chunk in pd.read_csv(ratings_csv, usecols=list(RATING_DTYPES), dtype=RATING_DTYPES, chunksize=CHUNK_SIZE):
+        rows = book_index.get_indexer(chunk['ISBN'])
+        known = rows >= 0
+        yield chunk['User-ID'].to_numpy()[known], rows[known], chunk['Book-Rating'].to_numpy()[known]
+
+
+def _sources(books_csv, ratings_csv):
+    return {path: os.path.getmtime(path) for path in (books_csv, ratings_csv)}
+
+
+def prepare(min_book_ratings=MIN_BOOK_RATINGS, min_user_ratings=MIN_USER_RATINGS, books_csv=BOOKS_CSV, ratings_csv=RATINGS_CSV, out_dir=PREPARED_DIR):
+    book_index, title_of_book, titles = _read_books(books_csv)
+
+    # Pass 1: ratings per title (the old df.groupby('Book-Title').count())
+    title_counts = np.zeros(len(titles), dtype=np.int64)
+    for _, rows, _ in _rating_chunks(ratings_csv, book_index):
+        title_counts += np.bincount(title_of_book[rows], minlength=len(titles))
+    popular = title_counts >= min_book_ratings
+
+    # Pass 2: ratings per user, counting only popular titles
+    user_counts = pd.Series(dtype=np.int64)
+    for users, rows, _ in _rating_chunks(ratings_csv, book_index):
+        counts = pd.Series(users[popular[title_of_book[rows]]]).value_counts()
+        user_counts = user_counts.add(counts, fill_value=0)
+    active_users = user_counts.index[user_counts >= min_user_ratings].to_numpy()
+
+    # Pass 3: keep ratings of popular titles by active users
+    kept = {'users': [], 'rows': [], 'ratings': []}
+    for users, rows, ratings in _rating_chunks(ratings_csv, book_index):
+        mask = popular[title_of_book[rows]] & np.isin(users, active_users)
+        kept['users'].append(users[mask])
+        kept['rows'].append(rows[mask])
+        kept['ratings'].append(ratings[mask])
+    users, rows, ratings = (np.concatenate(kept[k]) if kept[k] else np.empty(0) for k in ('users', 'rows', 'ratings'))
+
+    # Re-encode against the books that survived, so the vocabularies stay small
+    used_books, isbn_codes = np.unique(rows, return_inverse=True)
+    used_titles, title_codes = np.unique(title_of_book[used_books][isbn_codes], return_inverse=True)
+    os.makedirs(out_dir, exist_ok=True)
+    np.save(os.path.join(out_dir, 'user_ids.npy'), users.astype(np.int32))
+    np.save(os.path.join(out_dir, 'ratings.npy'), ratings.astype(np.int8))
+    np.save(os.path.join(out_dir, 'isbn_codes.npy'), isbn_codes.astype(np.int32))
+    np.save(os.path.join(out_dir, 'isbns.npy'), np.asarray(book_index[used_books], dtype=str))
+    np.save(os.path.join(out_dir, 'title_codes.npy'), title_codes.astype(np.int32))
+    np.save(os.path.join(out_dir, 'titles.npy'), titles[used_titles])
+    meta = {'min_book_ratings': min_book_ratings, 'min_user_ratings': min_user_ratings,
+            'sources': _sources(books_csv, ratings_csv), 'rows': int(len(users)),
+            'popular_titles': int(popular.sum()), 'active_users': int(len(active_users))}
+    with open(os.path.join(out_dir, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def is_current(min_book_ratings=MIN_BOOK_RATINGS, min_user_ratings=MIN_USER_RATINGS, books_csv=BOOKS_CSV, ratings_csv=RATINGS_CSV, out_dir=PREPARED_DIR):
+    try:
+        with open(os.path.join(out_dir, META_FILE)) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return False
+    return (meta['min_book_ratings'], meta['min_user_ratings']) == (min_book_ratings, min_user_ratings) \
+        and meta['sources'] == _sources(books_csv, ratings_csv)
+
+
+def load_prepared(min_book_ratings=MIN_BOOK_RATINGS, min_user_ratings=MIN_USER_RATINGS, books_csv=BOOKS_CSV, ratings_csv=RATINGS_CSV, out_dir=PREPARED_DIR):
+    # Filtered ratings as a DataFrame with the columns the builders used from the old merge.
+    # Runs the streaming passes only when the intermediate is missing or out of date.
+    if not is_current(min_book_ratings, min_user_ratings, books_csv, ratings_csv, out_dir):
+        print("Preprocessing ratings (streaming passes over the CSVs)...")
+        prepare(min_book_ratings, min_user_ratings, books_csv, ratings_csv, out_dir)
+    else:
+        print(f"Reusing preprocessed ratings from {out_dir}/")
+    load = lambda name: np.load(os.path.join(out_dir, name))
+    final_df = pd.DataFrame({
+        'User-ID': load('user_ids.npy'),
+        'ISBN': load('isbns.npy')[load('isbn_codes.npy')],
+        'Book-Title': load('titles.npy')[load('title_codes.npy')],
+        'Book-Rating': load('ratings.npy'),
+    })
+    print("Shape of final dataframe with active users:", final_df.shape)
+    return final_df
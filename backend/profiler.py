@@ -0,0 +1,74 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+# Opt-in sampling profiler for slow requests. While enabled, a daemon thread samples the
+# stack of every thread that is serving a request; when a request ends above the
+# threshold its samples are appended to PROFILE_DIR/<endpoint>.folded in the folded-stack
+# format read by flamegraph.pl and speedscope ("frame;frame;frame count" per line).
+
+
+def _frame_name(frame):
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def fold(frame):
+    names = []
+    while frame is not None:
+        names.append(_frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class SamplingProfiler:
+    def __init__(self, out_dir='profiles', threshold_ms=500, interval_ms=5):
+        self.out_dir = out_dir
+        self.threshold_ms = threshold_ms
+        self.interval = interval_ms / 1000
+        self.enabled = False
+        self._active = {}  # thread ident -> Counter of folded stacks
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def enable(self, threshold_ms=None):
+        if threshold_ms is not None:
+            self.threshold_ms = threshold_ms
+        self.enabled = True
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+            self._thread.start()
+
+    def disable(self):
+        self.enabled = False
+        with self._lock:
+            self._active.clear()
+
+    def start_request(self):
+        if self.enabled:
+            with self._lock:
+                self._active[threading.get_ident()] = Counter()
+
+    def end_request(self, endpoint, elapsed_seconds):
+        with self._lock:
+            samples = self._active.pop(threading.get_ident(), None)
+        if not samples or elapsed_seconds * 1000 < self.threshold_ms:
+            return None
+        os.makedirs(self.out_dir, exist_ok=True)
+        path = os.path.join(self.out_dir, re.sub(r'[^A-Za-z0-9_.-]+', '_', endpoint).strip('_') + '.folded')
+        with self._lock, open(path, 'a') as f:
+            f.writelines(f"{stack} {count}\n" for stack, count in samples.items())
+        return path
+
+    def _run(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, samples in self._active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        samples[fold(frame)] += 1
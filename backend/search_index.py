@@ -0,0 +1,93 @@
+import base64
+import json
+import re
+import threading
+from collections import defaultdict
+
+# Page size for /search and the largest page a client may ask for.
+SEARCH_PAGE_SIZE = 100
+MAX_SEARCH_PAGE_SIZE = 500
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def encode_cursor(rank, book_id):
+    return base64.urlsafe_b64encode(json.dumps([rank, book_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    # Returns (rank, book_id) or None; malformed cursors raise ValueError.
+    if not cursor:
+        return None
+    try:
+        rank, book_id = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        return float(rank), int(book_id)
+    except Exception as e:
+        raise ValueError("Invalid cursor") from e
+
+
+def trigrams(text):
+    # Word trigrams padded the way pg_trgm does it, so local ranking tracks similarity() in Postgres.
+    grams = set()
+    for word in _WORD_RE.findall(text.lower()):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def similarity(query_grams, text_grams):
+    if not query_grams or not text_grams:
+        return 0.0
+    return len(query_grams & text_grams) / len(query_grams | text_grams)
+
+
+class LocalSearchIndex:
+    # In-process trigram inverted index over title and author, used when the database
+    # has no pg_trgm (SQLite in tests and local runs). Postgres uses GIN trigram indexes instead.
+    def __init__(self):
+        self.postings = defaultdict(set)
+        self.docs = {}
+        self.loaded = False
+        self._lock = threading.Lock()
+
+    def add(self, book_id, title, author, genre, price):
+        title, author = (title or "").lower(), (author or "").lower()
+        title_grams, author_grams = trigrams(title), trigrams(author)
+        with self._lock:
+            self.docs[book_id] = (title, author, title_grams, author_grams, genre, price)
+            for gram in title_grams | author_grams:
+                self.postings[gram].add(book_id)
+
+    def load(self, rows):
+        for row in rows:
+            self.add(*row)
+        self.loaded = True
+
+    def _candidates(self, term):
+        # A substring match contains every space-free trigram of the term's words (padded
+        # ones assume word boundaries). Words shorter than 3 characters have none, so scan.
+        grams = [self.postings.get(g, set()) for g in trigrams(term) if " " not in g]
+        return set.intersection(*grams) if grams else set(self.docs)
+
+    def search(self, term, genre=None, max_price=None, after=None, limit=SEARCH_PAGE_SIZE):
+        # Returns ([(rank, book_id)], next_cursor) ordered by rank desc, id asc (keyset pagination).
+        term = term.lower()
+        query_grams = trigrams(term)
+        matches = []
+        with self._lock:
+            for book_id in self._candidates(term):
+                title, author, title_grams, author_grams, book_genre, price = self.docs[book_id]
+                if term not in title and term not in author:
+                    continue
+                if genre is not None and book_genre != genre:
+                    continue
+                if max_price is not None and (price is None or price > max_price):
+                    continue
+                rank = round(max(similarity(query_grams, title_grams), similarity(query_grams, author_grams)), 6)
+                matches.append((rank, book_id))
+        matches.sort(key=lambda m: (-m[0], m[1]))
+        if after is not None:
+            matches = [m for m in matches if m[0] < after[0] or (m[0] == after[0] and m[1] > after[1])]
+        page = matches[:limit]
+        next_cursor = encode_cursor(*page[-1]) if len(matches) > limit else None
+        return page, next_cursor
@@ -1,48 +1,176 @@
+import argparse
+import csv
+import io
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
 import pandas as pd
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
 from app import app, db, Book
 
-print("Starting database seed process...")
-
-# Use the app context to interact with the database
-with app.app_context():
-    print("Deleting existing books to prevent duplicates...")
-    db.session.query(Book).delete()
-    db.session.commit()
-
-    print("Loading data from books_enriched.csv...")
-    books_df = pd.read_csv('books_enriched.csv', low_memory=False)
-
-    books_df['ISBN'] = books_df['ISBN'].astype(str).str.strip()
-
-    # Clean up column names to match our database model
-    books_df.rename(columns={
-        'ISBN': 'isbn',
-        'Book-Title': 'title',
-        'Book-Author': 'author',
-        'Year-Of-Publication': 'year',
-        'Publisher': 'publisher',
-        'Image-URL-M': 'image_url_m',
-        'Genre': 'genre',
-        'Price': 'price'
-    }, inplace=True)
-    
-    # Select only the columns we need for the Book model
-    books_to_insert = books_df[['isbn', 'title', 'author', 'year', 'publisher', 'image_url_m', 'genre', 'price']].copy()
-    
-    # Remove duplicates based on ISBN to ensure uniqueness
-    books_to_insert.drop_duplicates(subset=['isbn'], inplace=True)
-    
-    # Handle potential missing values that can cause errors
-    books_to_insert['author'].fillna('Unknown', inplace=True)
-    books_to_insert['publisher'].fillna('Unknown', inplace=True)
-    books_to_insert['image_url_m'].fillna('', inplace=True)
-    
-    print(f"Preparing to insert {len(books_to_insert)} unique books into the database...")
-    
-    # Convert dataframe to a list of dictionaries and insert into the database
-    books_data = books_to_insert.to_dict(orient='records')
-    db.session.bulk_insert_mappings(Book, books_data)
-    
-    print("Committing changes to the database...")
-    db.session.commit()
-    print("Database seeding complete!")
\ No newline at end of file
+# Streams books_enriched.csv into the book table in batches. Every batch is an upsert on
+# isbn committed on its own, so existing books keep their ids (ratings and reviews reference
+# them) and a failure only loses the batch in flight. Finished batches are recorded in a
+# checkpoint file and skipped when the loader is rerun:
+#
+#   python seed_database.py --batch-size 5000 --workers 4 [--copy]
+
+COLUMNS = {
+    'ISBN': 'isbn',
+    'Book-Title': 'title',
+    'Book-Author': 'author',
+    'Year-Of-Publication': 'year',
+    'Publisher': 'publisher',
+    'Image-URL-M': 'image_url_m',
+    'Genre': 'genre',
+    'Price': 'price',
+}
+CSV_DTYPES = {'ISBN': str, 'Year-Of-Publication': str}
+# Handle potential missing values that can cause errors
+DEFAULTS = {'author': 'Unknown', 'publisher': 'Unknown', 'image_url_m': ''}
+UPDATE_COLUMNS = [c for c in COLUMNS.values() if c != 'isbn']
+INSERTS = {'postgresql': pg_insert, 'sqlite': sqlite_insert}
+COPY_NULL = '\\N'
+
+
+def superseded_rows(csv_path):
+    # Rows whose ISBN appears again further down the file with a title. Dropping them before
+    # batching makes the last row win even when parallel writers commit batches out of order.
+    rows = pd.read_csv(csv_path, usecols=['ISBN', 'Book-Title'], dtype=CSV_DTYPES)
+    isbns = rows['ISBN'].astype(str).str.strip().where(rows['Book-Title'].notna())
+    return (isbns.notna() & isbns.duplicated(keep='last')).to_numpy()
+
+
+def prepare_batch(chunk, superseded):
+    # chunk.index holds the rows' positions in the file
+    books = chunk[~superseded[chunk.index]].rename(columns=COLUMNS)[list(COLUMNS.values())]
+    books['isbn'] = books['isbn'].astype(str).str.strip()
+    return books.dropna(subset=['title']).fillna(DEFAULTS)
+
+
+def upsert(connection, books):
+    # Multi-row INSERT ... ON CONFLICT (isbn) DO UPDATE
+    insert = INSERTS.get(connection.dialect.name)
+    if insert is None:
+        raise RuntimeError(f"Upserts are not supported on {connection.dialect.name}; use Postgres or SQLite.")
+    stmt = insert(Book.__table__)
+    stmt = stmt.on_conflict_do_update(index_elements=['isbn'], set_={c: stmt.excluded[c] for c in UPDATE_COLUMNS})
+    rows = books.astype(object).where(books.notna(), None).to_dict(orient='records')
+    connection.execute(stmt, rows)
+
+
+def copy_upsert(connection, books):
+    # Postgres only: COPY the batch into a temp table, then upsert it with one INSERT ... SELECT
+    columns = ', '.join(COLUMNS.values())
+    cursor = connection.connection.cursor()
+    cursor.execute(
+        "CREATE TEMP TABLE IF NOT EXISTS book_load (isbn text, title text, author text, year text, "
+        "publisher text, image_url_m text, genre text, price double precision) ON COMMIT DELETE ROWS")
+    buffer = io.StringIO()
+    books.to_csv(buffer, index=False, header=False, na_rep=COPY_NULL, quoting=csv.QUOTE_MINIMAL)
+    buffer.seek(0)
+    cursor.copy_expert(f"COPY book_load ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')", buffer)
+    updates = ', '.join(f"{c} = EXCLUDED.{c}" for c in UPDATE_COLUMNS)
+    connection.execute(text(f"INSERT INTO book ({columns}) SELECT {columns} FROM book_load ON CONFLICT (isbn) DO UPDATE SET {updates}"))
+
+
+def load_batch(number, books, use_copy=False):
+    with app.app_context():
+        with db.engine.begin() as connection:
+            (copy_upsert if use_copy else upsert)(connection, books)
+    return number, len(books)
+
+
+def _init_worker():
+    # Forked workers must not share the parent's pooled connections
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+
+def _source(csv_path, batch_size):
+    return {'csv': os.path.abspath(csv_path), 'mtime': os.path.getmtime(csv_path), 'batch_size': batch_size}
+
+
+def read_checkpoint(path, source):
+    # Batch numbers only line up with the same file read with the same batch size
+    try:
+        with open(path) as f:
+            checkpoint = json.load(f)
+    except FileNotFoundError:
+        return set(), 0
+    if checkpoint.get('source') != source:
+        print(f"Ignoring {path}: it was written for a different CSV or batch size.")
+        return set(), 0
+    return set(checkpoint['done']), checkpoint['rows']
+
+
+def write_checkpoint(path, source, done, rows):
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'source': source, 'done': sorted(done), 'rows': rows}, f)
+    os.replace(path + '.tmp', path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load books_enriched.csv into the book table.")
+    parser.add_argument('--csv', default='books_enriched.csv')
+    parser.add_argument('--batch-size', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=1, help="writer processes (1 writes from this process)")
+    parser.add_argument('--copy', action='store_true', help="Postgres: COPY each batch into a temp table before the upsert")
+    parser.add_argument('--checkpoint', default='seed_checkpoint.json')
+    parser.add_argument('--restart', action='store_true', help="ignore an existing checkpoint and load every batch")
+    args = parser.parse_args()
+
+    source = _source(args.csv, args.batch_size)
+    done, rows = (set(), 0) if args.restart else read_checkpoint(args.checkpoint, source)
+    if done:
+        print(f"Resuming: skipping {len(done)} batches ({rows} books) already loaded.")
+    print(f"Loading {args.csv} in batches of {args.batch_size} with {args.workers} writer(s)...")
+
+    start, loaded = time.perf_counter(), 0
+
+    def record(result):
+        nonlocal rows, loaded
+        number, count = result
+        done.add(number)
+        rows += count
+        loaded += count
+        write_checkpoint(args.checkpoint, source, done, rows)
+        print(f"  batch {number}: {count} books, {loaded / (time.perf_counter() - start):,.0f} rows/sec")
+
+    superseded = superseded_rows(args.csv)
+    reader = pd.read_csv(args.csv, usecols=list(COLUMNS), dtype=CSV_DTYPES, chunksize=args.batch_size)
+    pool = ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker) if args.workers > 1 else None
+    pending = set()
+    try:
+        for number, chunk in enumerate(reader):
+            if number in done:
+                continue
+            books = prepare_batch(chunk, superseded)
+            if pool is None:
+                record(load_batch(number, books, args.copy))
+                continue
+            pending.add(pool.submit(load_batch, number, books, args.copy))
+            # Bound the batches held in memory while the writers catch up
+            if len(pending) >= args.workers * 2:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    record(future.result())
+        for future in pending:
+            record(future.result())
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+    elapsed = time.perf_counter() - start
+    print(f"Database seeding complete: {loaded} books in {elapsed:.1f}s ({loaded / max(elapsed, 1e-9):,.0f} rows/sec).")
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+
+if __name__ == '__main__':
+    main()
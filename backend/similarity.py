@@ -0,0 +1,85 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from neighbor_index import top_k_neighbors, DEFAULT_K
+
+# Default peak-memory budget (MB) for one similarity block, per worker process.
+DEFAULT_MEMORY_MB = 256
+
+
+def build_sparse_pivot(final_df):
+    # Same layout as the old dense pivot_table (rows = ISBN, columns = User-ID),
+    # but stored as CSR so users who did not rate a book cost nothing.
+    # pivot_table() averages duplicate (ISBN, user) pairs, so do the same here.
+    cells = final_df.groupby(['ISBN', 'User-ID'])['Book-Rating'].mean().reset_index()
+    isbn_codes, isbns = pd.factorize(cells['ISBN'], sort=True)
+    user_codes, user_ids = pd.factorize(cells['User-ID'], sort=True)
+    values = cells['Book-Rating'].to_numpy(dtype=np.float64)
+    pivot = sparse.csr_matrix((values, (isbn_codes, user_codes)), shape=(len(isbns), len(user_ids)))
+    return pivot, np.asarray(isbns), np.asarray(user_ids)
+
+
+def normalize_rows(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1.0
+    return sparse.diags(1.0 / norms) @ matrix
+
+
+def rows_per_block(n_items, memory_mb=DEFAULT_MEMORY_MB):
+    # A block of r rows holds r x n float64 scores plus argpartition's int64 workspace and a scratch copy.
+    bytes_per_row = n_items * (8 + 8 + 8)
+    return max(1, int(memory_mb * 1024 * 1024 // bytes_per_row))
+
+
+# Per-process state for the worker pool, set once by _init_worker instead of pickling the matrix per task.
+_worker_matrix = None
+_worker_dense_out = None
+
+
+def _init_worker(normalized, dense_out):
+    global _worker_matrix, _worker_dense_out
+    _worker_matrix = normalized
+    _worker_dense_out = np.load(dense_out, mmap_mode='r+') if dense_out else None
+
+
+def _score_block(start, stop, k, matrix=None, dense_out=None):
+    matrix = _worker_matrix if matrix is None else matrix
+    dense_out = _worker_dense_out if dense_out is None else dense_out
+    block = (matrix[start:stop] @ matrix.T).toarray()
+    if dense_out is not None:
+        dense_out[start:stop] = block
+    ids, scores = top_k_neighbors(block, k, exclude=np.arange(start, stop))
+    return start, ids, scores
+
+
+def blocked_cosine_neighbors(pivot, k=DEFAULT_K, memory_mb=DEFAULT_MEMORY_MB, workers=1, dense_out=None):
+    # Cosine similarity between every pair of rows, computed one bounded block of rows at a time.
+    # Only the top-k neighbors of each row are kept; pass `dense_out` (a .npy path) to also
+    # spill the full n x n matrix to disk through a memmap.
+    normalized = normalize_rows(sparse.csr_matrix(pivot, dtype=np.float64))
+    n = normalized.shape[0]
+    k = min(k, max(n - 1, 0))
+    step = rows_per_block(n, memory_mb)
+    neighbor_ids = np.empty((n, k), dtype=np.int32)
+    neighbor_scores = np.empty((n, k), dtype=np.float32)
+    if dense_out:
+        np.lib.format.open_memmap(dense_out, mode='w+', dtype=np.float64, shape=(n, n)).flush()
+    blocks = [(start, min(start + step, n)) for start in range(0, n, step)]
+
+    if workers <= 1:
+        out = np.load(dense_out, mmap_mode='r+') if dense_out else None
+        results = (_score_block(start, stop, k, normalized, out) for start, stop in blocks)
+        for start, ids, scores in results:
+            neighbor_ids[start:start + len(ids)], neighbor_scores[start:start + len(ids)] = ids, scores
+        if out is not None:
+            out.flush()
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(normalized, dense_out)) as pool:
+            futures = [pool.submit(_score_block, start, stop, k) for start, stop in blocks]
+            for future in futures:
+                start, ids, scores = future.result()
+                neighbor_ids[start:start + len(ids)], neighbor_scores[start:start + len(ids)] = ids, scores
+    return neighbor_ids, neighbor_scores
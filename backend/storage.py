@@ -0,0 +1,61 @@
+import os
+import shutil
+import tempfile
+from urllib.parse import quote
+
+# Object storage for user uploads. Backends take a file on disk, so large objects are
+# streamed from there instead of being held in memory:
+#   upload(path, source_path, content_type)  store the file at `path` in the bucket
+#   public_url(path)                         URL the frontend can load it from
+
+
+class SupabaseStorage:
+    def __init__(self, url, key, bucket):
+        self.url, self.key, self.bucket = url, key, bucket
+        self._client = None
+
+    @property
+    def client(self):
+        # Created on first use, so the app starts (and the local backend works) without Supabase settings
+        if self._client is None:
+            from supabase import create_client
+
+            self._client = create_client(self.url, self.key)
+        return self._client
+
+    def upload(self, path, source_path, content_type):
+        # httpx reads the open file in chunks while sending the multipart body
+        with open(source_path, 'rb') as f:
+            self.client.storage.from_(self.bucket).upload(
+                path=path, file=f, file_options={"content-type": content_type, "upsert": "true"})
+
+    def public_url(self, path):
+        return f"{self.url}/storage/v1/object/public/{self.bucket}/{path}"
+
+
+class LocalStorage:
+    # Filesystem stand-in for development and tests; app.py serves `root` under `base_url`.
+    def __init__(self, root, base_url, bucket):
+        self.root = os.path.join(root, bucket)
+        self.base_url = base_url.rstrip('/')
+        self.bucket = bucket
+
+    def upload(self, path, source_path, content_type):
+        target = os.path.realpath(os.path.join(self.root, path))
+        if os.path.commonpath([target, os.path.realpath(self.root)]) != os.path.realpath(self.root):
+            raise ValueError(f"Storage path escapes the bucket: {path}")
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Copy next to the target then rename, so readers never see a partial file
+        fd, staging = tempfile.mkstemp(dir=os.path.dirname(target), suffix='.part')
+        with os.fdopen(fd, 'wb') as out, open(source_path, 'rb') as src:
+            shutil.copyfileobj(src, out)
+        os.replace(staging, target)
+
+    def public_url(self, path):
+        return f"{self.base_url}/{quote(self.bucket)}/{quote(path)}"
+
+
+def make_storage(backend, bucket, supabase_url=None, supabase_key=None, local_root='uploads', local_base_url='/media'):
+    if backend == 'local':
+        return LocalStorage(local_root, local_base_url, bucket)
+    return SupabaseStorage(supabase_url, supabase_key, bucket)
@@ -1,30 +1,19 @@
-import pandas as pd
 from surprise import Reader, Dataset, SVD
 from surprise.dump import dump
 import os
+from model_store import MODEL_DIR, MODEL_FILES, current_model_path, new_version_dir, link_artifacts, publish_version
+from content_index import CONTENT_FILES
+from ann_index import ANN_FILES
+from svd_model import save_svd_factors
+from preprocess import load_prepared
 
 print("Starting model building process...")
 
 # --- Load and Prepare Data ---
 print("Loading data...")
-# Load the datasets
-books = pd.read_csv('Books.csv', low_memory=False)
-ratings = pd.read_csv('Ratings.csv')
-
-# Merge them
-df = ratings.merge(books, on='ISBN')
-
-# Filter for popular books (>= 50 ratings)
-ratings_count = df.groupby('Book-Title').count()['Book-Rating'].reset_index()
-ratings_count.rename(columns={'Book-Rating': 'num_ratings'}, inplace=True)
-popular_books = ratings_count[ratings_count['num_ratings'] >= 50]['Book-Title']
-popular_df = df[df['Book-Title'].isin(popular_books)]
-
-# Filter for active users (>= 200 ratings)
-user_ratings_count = popular_df.groupby('User-ID').count()['Book-Rating'].reset_index()
-user_ratings_count.rename(columns={'Book-Rating': 'num_user_ratings'}, inplace=True)
-active_users = user_ratings_count[user_ratings_count['num_user_ratings'] >= 200]['User-ID']
-final_df = popular_df[popular_df['User-ID'].isin(active_users)]
+# Popular books (>= 50 ratings) rated by active users (>= 200 ratings). Shares the
+# preprocessed intermediate with model_builder.py, so whichever runs second skips it.
+final_df = load_prepared()
 
 # Prepare the data for the Surprise library
 # The reader needs to know the scale of the ratings
@@ -52,4 +41,12 @@ model_filename = 'svd_model.pkl'
 print(f"Saving the trained model to {model_filename}...")
 dump(model_filename, algo=svd)
 
+# Export the latent factors as .npy so app.py can score users without Surprise. They go into a
+# new model version next to links to the live item-item, content and ANN artifacts: files of a
+# published version are never rewritten, since running workers have them memory-mapped.
+out_dir = new_version_dir(MODEL_DIR)
+link_artifacts(current_model_path(MODEL_DIR), out_dir, MODEL_FILES + CONTENT_FILES + ANN_FILES)
+save_svd_factors(out_dir, svd, trainset)
+print(f"Published model version {publish_version(MODEL_DIR, out_dir)} with the item factors.")
+
 print("Process finished successfully.")
\ No newline at end of file
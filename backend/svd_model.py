@@ -0,0 +1,107 @@
+import json
+import os
+
+import numpy as np
+
+from neighbor_index import top_k_neighbors
+
+# Latent factors exported by surprise_model_builder.py, stored next to the
+# item-item artifacts in MODEL_DIR and memory-mapped like them.
+SVD_ITEMS_FILE = 'svd_items.npy'                # row -> Book-Title the model was trained on
+SVD_ITEM_FACTORS_FILE = 'svd_item_factors.npy'  # (n_items, n_factors) float32, Surprise's qi
+SVD_ITEM_BIAS_FILE = 'svd_item_bias.npy'        # (n_items,) float32, Surprise's bi
+SVD_META_FILE = 'svd_meta.json'
+SVD_FILES = [SVD_ITEMS_FILE, SVD_ITEM_FACTORS_FILE, SVD_ITEM_BIAS_FILE, SVD_META_FILE]
+
+# Stars in the app are 1-5, the Book-Crossing ratings the model learned from are 1-10.
+STARS_TO_MODEL_SCALE = 2.0
+
+# Regularization used when folding a user into the trained factor space; the bias
+# is a damped mean so a single rating doesn't swing every prediction.
+FOLD_IN_REG = 0.1
+BIAS_DAMPING = 5.0
+
+
+def save_svd_factors(model_dir, svd, trainset):
+    os.makedirs(model_dir, exist_ok=True)
+    items = np.asarray([str(trainset.to_raw_iid(inner)) for inner in range(trainset.n_items)])
+    np.save(os.path.join(model_dir, SVD_ITEMS_FILE), items)
+    np.save(os.path.join(model_dir, SVD_ITEM_FACTORS_FILE), np.asarray(svd.qi, dtype=np.float32))
+    np.save(os.path.join(model_dir, SVD_ITEM_BIAS_FILE), np.asarray(svd.bi, dtype=np.float32))
+    meta = {"global_mean": float(trainset.global_mean), "rating_scale": list(trainset.rating_scale), "n_factors": int(svd.n_factors)}
+    with open(os.path.join(model_dir, SVD_META_FILE), 'w') as f:
+        json.dump(meta, f)
+
+
+class SvdModel:
+    def __init__(self, model_dir):
+        self.items = np.load(os.path.join(model_dir, SVD_ITEMS_FILE), mmap_mode='r')
+        self.item_factors = np.load(os.path.join(model_dir, SVD_ITEM_FACTORS_FILE), mmap_mode='r')
+        self.item_bias = np.load(os.path.join(model_dir, SVD_ITEM_BIAS_FILE), mmap_mode='r')
+        with open(os.path.join(model_dir, SVD_META_FILE)) as f:
+            meta = json.load(f)
+        self.global_mean = meta["global_mean"]
+        self.rating_scale = meta["rating_scale"]
+        self.row_of = {str(title): row for row, title in enumerate(self.items)}
+        self._norms = None
+
+    @classmethod
+    def load(cls, model_dir):
+        # None when surprise_model_builder.py hasn't been run for this model directory.
+        if not os.path.exists(os.path.join(model_dir, SVD_META_FILE)):
+            return None
+        return cls(model_dir)
+
+    @property
+    def norms(self):
+        # Item factor lengths, computed on first use (one pass over the factors)
+        if self._norms is None:
+            norms = np.linalg.norm(np.asarray(self.item_factors, dtype=np.float32), axis=1)
+            self._norms = np.where(norms > 0, norms, 1).astype(np.float32)
+        return self._norms
+
+    def similar_items(self, title, n=10):
+        # [(book_title, cosine of the item factors)] best first, the book itself excluded
+        row = self.row_of[title]
+        scores = (self.item_factors @ np.asarray(self.item_factors[row])) / (self.norms * self.norms[row])
+        ids, best = top_k_neighbors(np.asarray(scores)[np.newaxis, :], n, exclude=[row])
+        return [(str(self.items[i]), float(s)) for i, s in zip(ids[0], best[0])]
+
+    def item_similarity(self, title, titles):
+        # Cosine of the item factors of `title` with each of `titles`; NaN for titles the model hasn't seen
+        rows = np.asarray([self.row_of.get(t, -1) for t in titles], dtype=np.int64)
+        scores = np.full(len(titles), np.nan, dtype=np.float32)
+        known = rows >= 0
+        if title in self.row_of and known.any():
+            row = self.row_of[title]
+            scores[known] = (np.asarray(self.item_factors[rows[known]]) @ np.asarray(self.item_factors[row])) / (self.norms[rows[known]] * self.norms[row])
+        return scores
+
+    def fold_in(self, rows, ratings):
+        # User bias and factors for ratings made after training: one ridge-regression
+        # solve against the fixed item factors instead of retraining the model.
+        factors = np.asarray(self.item_factors[rows], dtype=np.float64)
+        residual = ratings - self.global_mean - np.asarray(self.item_bias[rows], dtype=np.float64)
+        user_bias = residual.sum() / (len(rows) + BIAS_DAMPING)
+        residual = residual - user_bias
+        gram = factors.T @ factors + FOLD_IN_REG * len(rows) * np.eye(factors.shape[1])
+        return user_bias, np.linalg.solve(gram, factors.T @ residual)
+
+    def recommend_for(self, star_ratings, n=10):
+        # star_ratings: {book_title: stars}. Returns [(book_title, predicted stars)] best first,
+        # scoring every item with one matrix-vector product and an argpartition.
+        rated = [(self.row_of[t], r * STARS_TO_MODEL_SCALE) for t, r in star_ratings.items() if t in self.row_of]
+        if rated:
+            rows = np.asarray([row for row, _ in rated])
+            user_bias, user_factors = self.fold_in(rows, np.asarray([r for _, r in rated], dtype=np.float64))
+            scores = self.global_mean + user_bias + self.item_bias + self.item_factors @ user_factors.astype(np.float32)
+        else:
+            # Cold user: the bias terms alone rank items by how well they are liked overall
+            rows = np.empty(0, dtype=np.int64)
+            scores = self.global_mean + np.asarray(self.item_bias)
+        # Rank on raw scores (clipping would tie everything above the scale), report clipped predictions
+        scores = np.asarray(scores, dtype=np.float32)
+        scores[rows] = -np.inf
+        ids, best = top_k_neighbors(scores[np.newaxis, :], n)
+        low, high = self.rating_scale
+        return [(str(self.items[i]), float(np.clip(s, low, high)) / STARS_TO_MODEL_SCALE) for i, s in zip(ids[0], best[0]) if np.isfinite(s)]
@@ -0,0 +1,69 @@
+import os
+import shutil
+import sqlite3
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import model_store
+
+# Two SQLite files stand in for the primary and its replica. The replica copy then diverges
+# (it holds a stale rating), so each response shows which database served it.
+ISBN, TITLE = '0000000001', 'Replicated Book'
+
+
+@pytest.fixture(scope='module')
+def api(tmp_path_factory):
+    tmp = tmp_path_factory.mktemp('routing')
+    primary, replica = tmp / 'primary.db', tmp / 'replica.db'
+    model_store.save_artifacts(str(tmp / 'model'), [ISBN], [[0]], [[0.0]])
+    model_store.MODEL_DIR = str(tmp / 'model')  # read when app is imported; the module may already be loaded
+    os.environ.update(DATABASE_URL=f"sqlite:///{primary}", DATABASE_REPLICA_URL=f"sqlite:///{replica}",
+                      OTP_STORE='memory', JWT_SECRET_KEY='routing-test-secret-' * 2,
+                      SUPABASE_URL='https://example.supabase.co', SUPABASE_KEY='key')
+    import app as api
+
+    with api.app.app_context():
+        api.db.create_all(bind_key=None)
+        for name in ('ann', 'bob'):
+            api.db.session.add(api.User(username=name, email=f"{name}@example.com", password_hash='x', is_verified=True))
+        api.db.session.add(api.Book(isbn=ISBN, title=TITLE, author='Author', genre='Fiction', price=10.0))
+        api.db.session.commit()
+        api.db.engine.dispose()
+    shutil.copy(primary, replica)
+    with sqlite3.connect(replica) as connection:
+        connection.execute("INSERT INTO rating (user_id, book_title, book_id, rating) "
+                           "SELECT user.id, ?, 1, 1 FROM user", (TITLE,))
+    return api
+
+
+def token(api, username):
+    with api.app.app_context():
+        user = api.User.query.filter_by(username=username).one()
+        return {'Authorization': f"Bearer {api.create_access_token(identity=username, additional_claims=api.identity_claims(user))}"}
+
+
+def my_ratings(client, headers):
+    response = client.get('/my-ratings', headers=headers)
+    assert response.status_code == 200
+    return [r['user_rating'] for r in response.get_json()]
+
+
+def test_reads_go_to_the_replica_until_the_user_writes(api):
+    client = api.app.test_client()
+    ann, bob = token(api, 'ann'), token(api, 'bob')
+    assert my_ratings(client, ann) == [1]
+
+    response = client.post('/rate', json={'title': TITLE, 'isbn': ISBN, 'rating': 4}, headers=ann)
+    assert response.status_code == 200
+    # The writer is pinned to the primary and reads their rating back...
+    assert my_ratings(client, ann) == [4]
+    # ...while other users keep reading the replica
+    assert my_ratings(client, bob) == [1]
+
+
+def test_writes_never_reach_the_replica(api):
+    with sqlite3.connect(api.app.config['SQLALCHEMY_BINDS']['replica']['url'].removeprefix('sqlite:///')) as connection:
+        assert connection.execute("SELECT rating FROM rating").fetchall() == [(1,), (1,)]
@@ -0,0 +1,59 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+from scipy import sparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from incremental_updater import (
+    WATERMARK_OVERLAP_SECONDS, apply_ratings, seen_within_overlap, unseen_ratings, update_neighbors,
+)
+from similarity import blocked_cosine_neighbors
+
+# update_neighbors() is approximate: a book's list only gains or loses the rated books, so a
+# neighbor that was past the K stored ones can't come back. The accepted tolerance is that
+# the neighbors /recommend serves (the first SERVED of K) match a full rebuild exactly.
+K, SERVED = 20, 5
+
+
+def synthetic_pivot(seed, books=300, users=400, density=0.05):
+    rng = np.random.default_rng(seed)
+    pivot = sparse.random(books, users, density=density, format='csr', random_state=rng,
+                          data_rvs=lambda size: rng.integers(1, 11, size).astype(np.float64))
+    return pivot, np.arange(1, users + 1)
+
+
+def test_served_neighbors_match_full_rebuild():
+    pivot, user_ids = synthetic_pivot(seed=7)
+    neighbor_ids, neighbor_scores = blocked_cosine_neighbors(pivot, k=K)
+    rng = np.random.default_rng(8)
+    # 50 app users (negative ids, as in run_update) rating existing books
+    updates = [(int(row), -int(user), float(value)) for row, user, value in
+               zip(rng.integers(0, pivot.shape[0], 200), rng.integers(1, 51, 200), rng.integers(2, 11, 200))]
+    pivot, user_ids = apply_ratings(pivot, user_ids, updates)
+    affected = np.unique([row for row, _, _ in updates])
+
+    ids, scores = update_neighbors(pivot, neighbor_ids, neighbor_scores, affected)
+    full_ids, full_scores = blocked_cosine_neighbors(pivot, k=K)
+
+    np.testing.assert_allclose(scores[:, :SERVED], full_scores[:, :SERVED], atol=1e-5)
+    # Ids may only differ where scores tie
+    mismatch = ids[:, :SERVED] != full_ids[:, :SERVED]
+    assert np.all(np.isclose(scores[:, :SERVED][mismatch], full_scores[:, :SERVED][mismatch], atol=1e-5))
+    # Affected rows are recomputed from scratch, so their whole list is exact
+    np.testing.assert_allclose(scores[affected], full_scores[affected], atol=1e-5)
+
+
+def test_overlap_picks_up_late_commits_once():
+    t = datetime(2026, 1, 1, 12, 0, 0)
+    # Rating 1 was folded in; rating 2 was flushed earlier but committed after that run
+    first_run = [(1, 10, 'a', 5, t)]
+    seen = {tuple(s) for s in seen_within_overlap(first_run, t)}
+    second_run = [(2, 11, 'b', 4, t - timedelta(seconds=1)), (1, 10, 'a', 5, t)]
+    assert unseen_ratings(second_run, seen) == [second_run[0]]
+    # A rerated row gets a new updated_at and is folded in again
+    assert unseen_ratings([(1, 10, 'a', 3, t + timedelta(seconds=5))], seen) != []
+    # Ratings older than the overlap window are forgotten
+    assert seen_within_overlap(second_run, t + timedelta(seconds=WATERMARK_OVERLAP_SECONDS)) == []
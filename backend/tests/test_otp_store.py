@@ -0,0 +1,102 @@
+import os
+import sys
+from datetime import datetime
+
+import pytest
+from sqlalchemy import Column, DateTime, Integer, String, create_engine
+from sqlalchemy.orm import declarative_base, sessionmaker
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from otp_store import MemoryOtpStore, SqlOtpStore, TooManyAttempts, TooManyRequests
+
+Base = declarative_base()
+
+
+class OtpCode(Base):
+    # Same columns as app.OtpCode
+    __tablename__ = 'otp_code'
+    key = Column(String(120), primary_key=True)
+    code = Column(String(12))
+    expires_at = Column(DateTime, index=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    issued = Column(Integer, default=0, nullable=False)
+    window_started = Column(DateTime, nullable=False)
+
+
+@pytest.fixture
+def sql_session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'otp.db'}")
+    Base.metadata.create_all(engine)
+    sessions = sessionmaker(engine)
+    yield sessions
+    engine.dispose()
+
+
+@pytest.fixture(params=['memory', 'sql'])
+def make_store(request, sql_session):
+    def make(**limits):
+        if request.param == 'memory':
+            return MemoryOtpStore(**limits)
+        return SqlOtpStore(sql_session(), OtpCode, **limits)
+    return make
+
+
+def test_code_verifies_once(make_store):
+    store = make_store()
+    store.issue('verify:ann', '123456')
+    assert store.verify('verify:ann', '123456')
+    assert not store.verify('verify:ann', '123456')
+
+
+def test_expired_code_is_rejected(make_store):
+    store = make_store(ttl=0)
+    store.issue('verify:ann', '123456')
+    assert not store.verify('verify:ann', '123456')
+
+
+def test_code_is_discarded_after_max_attempts(make_store):
+    store = make_store(max_attempts=3)
+    store.issue('reset:ann', '123456')
+    assert not store.verify('reset:ann', '000000')
+    assert not store.verify('reset:ann', '000001')
+    with pytest.raises(TooManyAttempts):
+        store.verify('reset:ann', '000002')
+    assert not store.verify('reset:ann', '123456')
+
+
+def test_issues_are_throttled_per_window(make_store):
+    store = make_store(max_issues=2)
+    store.issue('verify:ann', '111111')
+    store.issue('verify:ann', '222222')
+    with pytest.raises(TooManyRequests):
+        store.issue('verify:ann', '333333')
+    # The last code sent is still valid, and other keys are unaffected
+    assert store.verify('verify:ann', '222222')
+    store.issue('verify:bob', '444444')
+
+
+def test_issue_window_resets(make_store):
+    store = make_store(max_issues=1, issue_window=0)
+    store.issue('verify:ann', '111111')
+    store.issue('verify:ann', '222222')
+    assert store.verify('verify:ann', '222222')
+
+
+def test_first_issue_that_loses_the_insert_race_reuses_the_row(sql_session):
+    # SQLite serializes writers, so the race is replayed by hand: another worker created the
+    # row after this one found none. The losing insert must be a no-op, not an IntegrityError.
+    winner, loser = SqlOtpStore(sql_session(), OtpCode), SqlOtpStore(sql_session(), OtpCode)
+    winner.issue('verify:ann', '111111')
+    loser._ensure_row('verify:ann', datetime.utcnow())
+    loser.session.commit()
+    loser.issue('verify:ann', '222222')
+    row = sql_session().get(OtpCode, 'verify:ann')
+    assert (row.issued, row.code) == (2, '222222')
+
+
+def test_evict_keeps_rows_inside_the_issue_window(sql_session):
+    session = sql_session()
+    SqlOtpStore(session, OtpCode, ttl=0).issue('verify:ann', '123456')
+    assert SqlOtpStore(session, OtpCode, ttl=0).evict() == 0
+    assert SqlOtpStore(session, OtpCode, ttl=0, issue_window=0).evict() == 1
@@ -74,7 +74,7 @@ function MainPage() {
 		localStorage.removeItem("token");
 		window.location.reload();
 	};
-	const rateBook = async (title, rating) => {
+	const rateBook = async (title, isbn, rating) => {
 		if (profile && !profile.is_verified) {
 			setShowVerificationModal(true);
 			return;
@@ -91,7 +91,7 @@ function MainPage() {
 				"Content-Type": "application/json",
 				Authorization: `Bearer ${token}`,
 			},
-			body: JSON.stringify({ title, rating }),
+			body: JSON.stringify({ title, isbn, rating }),
 		});
 
 		// 2. Refresh the visible book list
@@ -308,6 +308,7 @@ function MainPage() {
 															e.stopPropagation();
 															rateBook(
 																book.title,
+																book.isbn,
 																star
 															);
 														}}
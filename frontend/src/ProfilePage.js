@@ -104,7 +104,8 @@ function ProfilePage() {
 
 			if (response.ok && data.profile_photo_url) {
 				setMessage("Photo successfully saved!");
-				setPhotoPreview(data.profile_photo_url);
+				// 202: the photo is still being processed, keep the local preview until then
+				if (response.status !== 202) setPhotoPreview(data.profile_photo_url);
 				setProfile((prev) => ({
 					...prev,
 					profile_photo_url: data.profile_photo_url,